@@ -1,5 +1,8 @@
 import asyncio
 import logging
+import logging.handlers
+import atexit
+import queue
 import json
 from telethon import TelegramClient, events, errors
 from telethon.tl.types import (
@@ -8,107 +11,1504 @@ from telethon.tl.types import (
     MessageMediaGeo, MessageMediaContact, MessageMediaVenue, 
     MessageMediaGame, MessageMediaInvoice, MessageMediaGeoLive,
     MessageMediaDice, MessageMediaStory, InputMediaPoll, Poll, 
-    PollAnswer, InputReplyToMessage, Updates, UpdateNewMessage
+    PollAnswer, InputReplyToMessage, Updates, UpdateNewMessage,
+    PhotoStrippedSize, PhotoPathSize, InputSingleMedia, UpdateMessageID
 )
-from telethon.tl.functions.messages import SendMediaRequest
-from collections import deque
+from telethon.tl.functions.messages import SendMediaRequest, SendMultiMediaRequest, ForwardMessagesRequest
+from telethon import utils, helpers
+from collections import deque, OrderedDict
+from array import array
+from contextlib import contextmanager
 from datetime import datetime
-import imagehash
-from PIL import Image
-import io
+import multiprocessing
+from image_hashing import compute_image_hash
 import traceback
 import re
+import time
+import hashlib
+import itertools
+import threading
+import sqlite3
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 # Configuration
 API_ID = 23617139  # Replace with your API ID
 API_HASH = "5bfc582b080fa09a1a2eaa6ee60fd5d4"  # Replace with your API hash
 SESSION_FILE = "userbot_session"
-client = TelegramClient(SESSION_FILE, API_ID, API_HASH)
+# Hash pool workers are spawned, which re-imports this script as __mp_main__; they must not touch the
+# session or log files, nor start threads
+IN_HASH_WORKER = __name__ == "__mp_main__"
+client = TelegramClient(None if IN_HASH_WORKER else SESSION_FILE, API_ID, API_HASH)
 
 MAPPINGS_FILE = "channel_mappings.json"
+CONFIG_BACKEND = "json"  # "json": MAPPINGS_FILE rewritten atomically; "sqlite": one row per pair in STATE_DB_FILE
+CONFIG_SAVE_DELAY = 1.0  # seconds to gather config changes before writing them
+STATE_DB_FILE = "forward_state.db"  # SQLite (WAL) database for the durable queue and other runtime state
 MAX_RETRIES = 3
 RETRY_DELAY = 5  # seconds
-MAX_QUEUE_SIZE = 100
-MAX_MAPPING_HISTORY = 1000
+MAX_QUEUE_SIZE = 100  # messages per lane kept in memory; the rest spill to the state database
+METRIC_COUNTERS = ('forwarded', 'edited', 'deleted', 'blocked', 'queued', 'failed')  # per-pair counters kept over time
+METRIC_SERIES = ((60, 60), (3600, 48))  # (bucket width in seconds, buckets kept): the last hour by minute, two days by hour
+METRICS_FLUSH_INTERVAL = 60  # seconds between writes of pair metrics to the state database
+METRICS_HOST = "127.0.0.1"  # interface the Prometheus endpoint listens on
+METRICS_PORT = None  # port for the Prometheus /metrics endpoint; None disables it
+LATENCY_BUCKETS = 640  # log-linear histogram buckets; 16 per power of two covers microseconds to days
+LATENCY_STAGES = ('queue_wait', 'rate_wait', 'flood_wait', 'reply', 'filter', 'phash', 'send', 'edit', 'delete', 'total')
+MAPPING_CACHE_SIZE = 5000  # forwarded-message ID mappings kept in the in-memory LRU cache
+MAPPING_FLUSH_INTERVAL = 2  # seconds between write-behind flushes of new ID mappings
+MAPPING_FLUSH_BATCH = 200  # pending ID mapping writes that trigger an immediate flush
+MAPPING_RETENTION_DAYS = 30  # default age limit for stored ID mappings per pair
+MAPPING_RETENTION_COUNT = 100000  # default max stored ID mappings per pair
+MAPPING_PRUNE_INTERVAL = 3600  # seconds between retention passes over the ID mapping store
+FAILED_RETENTION_DAYS = 7  # days failed messages are kept for /retryfailed before being dropped
 MONITOR_CHAT_ID = None
 NOTIFY_CHAT_ID = None
+OWNER_ID = None  # the account's own user ID, cached at startup; only its messages run commands
 INACTIVITY_THRESHOLD = 21600  # 6 hours in seconds
 MAX_MESSAGE_LENGTH = 4096  # Telegram's max message length
-FORWARD_DELAY = 1  # seconds delay between forwarding messages
+GLOBAL_RATE = 20.0  # max API requests per second across all chats
+DESTINATION_RATE = 1.0  # max messages per second sent to a single destination chat
+RPC_RATES = {'send': 15.0, 'edit': 10.0, 'delete': 10.0, 'get_messages': 10.0, 'search': 0.5}  # max requests per second per RPC type
+RATE_FLOOR = 0.05  # lowest fraction of its configured rate a throttled bucket can fall to
+RATE_RECOVERY_STREAK = 20  # successes in a row before a throttled bucket speeds up again
+RATE_RECOVERY_STEP = 1.1  # rate multiplier applied on each recovery step
+HASH_WORKERS = os.cpu_count() or 1  # processes used for perceptual image hashing
+HASH_QUEUE_LIMIT = HASH_WORKERS * 2  # images being hashed or waiting for a worker at once
+HASH_TIMEOUT = 10  # seconds before a message is forwarded without the image check
+IMAGE_HASH_THRESHOLD = 6  # default max Hamming distance (of 64 bits) for a photo to match a blocked image
+PHASH_MIN_SIZE = 320  # px; photos are hashed from the smallest thumbnail at least this large
+PHOTO_HASH_CACHE_SIZE = 10000  # photo hashes kept in memory
+PHOTO_HASH_CACHE_TTL = 86400  # seconds a cached photo hash stays valid
+PEER_REFRESH_INTERVAL = 3600  # seconds between background re-resolutions of every pair's input peers
+PEER_ERRORS = (errors.ChannelInvalidError, errors.PeerIdInvalidError, errors.ChatIdInvalidError)  # cached peer is stale
+REPLY_CACHE_SIZE = 5000  # reply targets resolved by search, or known to be unresolvable, kept in memory
+REPLY_CACHE_TTL = 3600  # seconds before an unresolved reply target may be looked up again
+REPLY_WARMUP_PER_PAIR = 500  # most recent ID mappings per pair loaded into memory at startup
+REPLY_SEARCH_FALLBACK = False  # search the destination by text for reply targets missing from the ID map
+EDIT_DEBOUNCE = 2.0  # seconds to wait for further edits of a source message before propagating the latest
+ALBUM_WINDOW = 1.0  # seconds to wait for the rest of an album (grouped_id) before sending it
+MAX_ALBUM_SIZE = 10  # Telegram's max items in one media group
+MAX_FORWARD_BATCH = 100  # max message IDs per server-side ForwardMessagesRequest
+DELETE_WINDOW = 1.0  # seconds to gather source deletions arriving in separate events before propagating them
+MAX_DELETE_BATCH = 100  # max message IDs per delete_messages call
+CATCHUP_BATCH = 100  # message IDs fetched per get_messages call while catching up on missed messages
+RECENTLY_QUEUED_SIZE = 20000  # (pair, message) keys remembered so catch-up and live updates never queue a message twice
+CLONE_PAGE_SIZE = 50  # source messages read per history page by /clonehistory
+MAX_ACTIVE_LANES = 4  # max destination lanes sending at the same time
+MAX_LANE_BACKOFF = 300  # seconds cap for a lane's failure backoff
+LANE_IDLE_TIMEOUT = 600  # seconds an empty lane worker waits before exiting
 QUEUE_INACTIVITY_THRESHOLD = 600  # 10 minutes in seconds for queue inactivity alert
+LOG_FILE = "forward_bot.log"
+LOG_JSON = True  # write the log file as one JSON object per line; the console stays plain text
+LOG_MAX_BYTES = 10 * 1024 * 1024  # log file size that triggers rotation
+LOG_BACKUPS = 5  # rotated log files kept
+LOG_SAMPLE_EVERY = 1  # keep 1 in N high-volume per-message info logs per pair; 1 keeps all
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record, with the pair attached where the call site provided one."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if hasattr(record, 'pair'):
+            entry['pair'] = record.pair
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class PairLogSampler(logging.Filter):
+    """Pass 1 in `every` records marked as sampled, counted separately per pair."""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self.seen = {}
+
+    def filter(self, record):
+        if self.every <= 1 or not getattr(record, 'sampled', False):
+            return True
+        seen = self.seen.get(record.pair, 0)
+        self.seen[record.pair] = seen + 1
+        return seen % self.every == 0
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Hand records to the listener thread unformatted, so formatting happens off the event loop."""
+
+    def prepare(self, record):
+        return record
 
-# Logging setup
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler("forward_bot.log"), logging.StreamHandler()]
+def sampled(pair_name):
+    """`extra` for high-volume per-message info logs, which are subject to LOG_SAMPLE_EVERY."""
+    return {'pair': pair_name, 'sampled': True}
+
+# Logging setup: the event loop only enqueues records; a listener thread formats and writes them
+log_queue = queue.SimpleQueue()
+log_file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, delay=True)
+log_file_handler.setFormatter(
+    JsonLogFormatter() if LOG_JSON else logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 )
+log_console_handler = logging.StreamHandler()
+log_console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_handler = DeferredQueueHandler(log_queue)
+log_handler.addFilter(PairLogSampler(LOG_SAMPLE_EVERY))
+logging.basicConfig(level=logging.INFO, handlers=[log_handler])
+log_listener = logging.handlers.QueueListener(log_queue, log_file_handler, log_console_handler)
+if not IN_HASH_WORKER:
+    log_listener.start()
+    atexit.register(log_listener.stop)
 logger = logging.getLogger("ForwardBot")
 
 # Data structures
 channel_mappings = {}
-message_queue = deque(maxlen=MAX_QUEUE_SIZE)  # Now stores (event, mapping, user_id, pair_name, queued_time)
+send_lanes = {}  # destination chat ID -> DestinationLane; items are (event, mapping, user_id, pair_name, queued_time, seq)
+durable_queue = None  # DurableQueue, opened in main()
+message_store = None  # MessageStore, opened in main()
+hash_pool = None  # ProcessPoolExecutor for image hashing, created in main()
+metrics = None  # MetricsStore, opened in main()
+latency_histograms = {}  # (user_id, pair_name, stage) -> LatencyHistogram
+config_store = None  # PairConfigStore, opened by load_mappings() when CONFIG_BACKEND is "sqlite"
+config_dirty = False  # channel_mappings changed since the last write was started
+config_save_task = None  # task writing channel_mappings after CONFIG_SAVE_DELAY
+config_write_lock = threading.Lock()  # one config write at a time, from the save task's thread or on shutdown
+config_generations = itertools.count(1)  # numbers snapshots in the order they were taken
+config_written = 0  # number of the newest snapshot on disk, so an older one never overwrites it
+hash_slots = asyncio.Semaphore(HASH_QUEUE_LIMIT)
+pending_edits = {}  # (source chat ID, message ID) -> [latest edit event, flush deadline]
+pending_deletes = {}  # source chat ID -> [deleted message IDs, flush deadline]
+command_handlers = {}  # "/name" -> (compiled argument pattern, handler), filled by @command
+catch_up_task = None  # task fetching messages missed while disconnected
+catch_up_from = None  # pair progress as of the last disconnect (or startup), where the next catch-up starts
+catch_up_progress = {}  # source chat ID -> [message IDs scanned, message IDs to scan] for a running catch-up
+catch_up_held = {}  # source chat ID -> live messages held back until its catch-up has queued the backlog
+clone_tasks = {}  # clone job ID -> [task, user_id, pair_name, last message ID queued, last message ID to clone]
+album_buffers = {}  # (source chat ID, grouped_id) -> [events, flush deadline] for albums still arriving
+input_peers = {}  # chat ID -> InputPeer resolved for it, so sends never need a resolution round-trip
+peer_refreshes = {}  # chat ID -> task re-resolving its InputPeer
+reply_searches = {}  # mapping key -> background search task for that reply target
+photo_hash_tasks = {}  # (photo id, access_hash) -> task currently downloading and hashing that photo
+lane_slots = asyncio.Semaphore(MAX_ACTIVE_LANES)
 is_connected = False
 pair_stats = {}
+source_index = {}  # source chat ID -> list of (user_id, pair_name, mapping) for active pairs
+indexed_pairs = {}  # (user_id, pair_name) -> source chat ID the pair is indexed under
+compiled_filters = {}  # (user_id, pair_name) -> CompiledFilters, dropped whenever the pair's filters change
+FILTER_SHARE_CACHE_SIZE = 256  # distinct filter configurations whose compiled matchers are shared between pairs
+
+URL_PATTERN = re.compile(r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+(?:/[^\s]*)?')
+MENTION_PATTERN = re.compile(r'@[a-zA-Z0-9_]+|\[([^\]]+)\]\(tg://user\?id=\d+\)')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+class DestinationLane:
+    """Ordered send queue with its own pacing and backoff for one destination chat."""
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.items = deque()
+        self.spilled = False  # newer messages are waiting on disk only
+        self.last_seq = 0  # highest queue sequence number loaded into memory
+        self.wakeup = asyncio.Event()
+        self.paused_until = 0.0  # event-loop time before which the lane must not send (failure backoff)
+        self.failures = 0
+        self.task = None
+
+    def pause(self, seconds):
+        """Hold this lane back for at least the given number of seconds."""
+        resume_at = asyncio.get_running_loop().time() + seconds
+        self.paused_until = max(self.paused_until, resume_at)
+
+class TokenBucket:
+    """Token bucket that slows down on flood waits and recovers after a run of successes."""
+
+    def __init__(self, rate):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = max(1.0, rate)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.streak = 0
+
+    @property
+    def capacity(self):
+        return max(1.0, self.rate)
+
+    def delay(self, now):
+        """Seconds until a token can be taken."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = self.blocked_until - now
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return max(wait, 0.0)
+
+    def take(self):
+        self.tokens -= 1
+
+    def penalize(self, seconds, now, factor=0.5):
+        """Cut the rate after a flood wait and, if given, block for the wait time."""
+        self.rate = max(self.max_rate * RATE_FLOOR, self.rate * factor)
+        self.streak = 0
+        if seconds:
+            self.tokens = min(self.tokens, 0.0)
+            self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def reward(self):
+        """Count a success and raise a throttled rate back towards its maximum."""
+        if self.rate >= self.max_rate:
+            return
+        self.streak += 1
+        if self.streak >= RATE_RECOVERY_STREAK:
+            self.rate = min(self.max_rate, self.rate * RATE_RECOVERY_STEP)
+            self.streak = 0
+
+class RateLimiter:
+    """Adaptive limits for the global, per-destination and per-RPC-type scopes."""
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_RATE)
+        self.rpc_buckets = {rpc: TokenBucket(rate) for rpc, rate in RPC_RATES.items()}
+        self.destination_buckets = {}
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+
+    def _destination_bucket(self, destination):
+        bucket = self.destination_buckets.get(destination)
+        if bucket is None:
+            bucket = self.destination_buckets[destination] = TokenBucket(DESTINATION_RATE)
+        return bucket
+
+    def _buckets(self, rpc, destination):
+        buckets = [self.global_bucket, self.rpc_buckets[rpc]]
+        if destination is not None:
+            buckets.append(self._destination_bucket(destination))
+        return buckets
+
+    async def acquire(self, rpc, destination=None):
+        """Wait until every scope the request falls under has a token, then take them."""
+        buckets = self._buckets(rpc, destination)
+        while True:
+            now = time.monotonic()
+            wait = max(bucket.delay(now) for bucket in buckets)
+            if wait <= 0:
+                for bucket in buckets:
+                    bucket.take()
+                return
+            await asyncio.sleep(wait)
+
+    def record_success(self, rpc, destination=None):
+        for bucket in self._buckets(rpc, destination):
+            bucket.reward()
+
+    def record_flood_wait(self, rpc, destination, seconds):
+        """Learn from a FloodWaitError; the narrowest known scope is blocked for the wait."""
+        now = time.monotonic()
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+        if destination is not None:
+            self._destination_bucket(destination).penalize(seconds, now)
+            self.rpc_buckets[rpc].penalize(0, now, factor=0.8)
+        else:
+            self.rpc_buckets[rpc].penalize(seconds, now)
+        self.global_bucket.penalize(0, now, factor=0.9)
+        logger.warning(
+            f"Flood wait of {seconds}s on '{rpc}' (destination: {destination}); "
+            f"rates now global={self.global_bucket.rate:.2f}/s {rpc}={self.rpc_buckets[rpc].rate:.2f}/s"
+        )
+
+rate_limiter = RateLimiter()
+
+def open_state_db(path, check_same_thread=True):
+    """Open the state database in WAL mode."""
+    db = sqlite3.connect(path, check_same_thread=check_same_thread)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+class DurableQueue:
+    """SQLite-backed record of every queued message, removed only once it has been delivered."""
+
+    def __init__(self, path):
+        self.db = open_state_db(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS queue ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " destination INTEGER NOT NULL,"
+            " user_id TEXT NOT NULL,"
+            " pair_name TEXT NOT NULL,"
+            " source_chat INTEGER NOT NULL,"
+            " message_id INTEGER NOT NULL,"
+            " queued_at TEXT NOT NULL,"
+            " failed INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS queue_pending ON queue (destination, failed, seq)")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(queue)")]
+        if 'album_ids' not in columns:
+            self.db.execute("ALTER TABLE queue ADD COLUMN album_ids TEXT")
+        # Highest source message ID queued per pair, the starting point for catching up after downtime
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pair_progress ("
+            " user_id TEXT NOT NULL,"
+            " pair_name TEXT NOT NULL,"
+            " source_chat INTEGER NOT NULL,"
+            " last_msg_id INTEGER NOT NULL,"
+            " PRIMARY KEY (user_id, pair_name)) WITHOUT ROWID"
+        )
+        # /clonehistory jobs; last_msg_id is the checkpoint a crashed or interrupted clone resumes after
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS clone_jobs ("
+            " job_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " user_id TEXT NOT NULL,"
+            " pair_name TEXT NOT NULL,"
+            " source_chat INTEGER NOT NULL,"
+            " first_msg_id INTEGER NOT NULL,"
+            " end_msg_id INTEGER NOT NULL,"
+            " last_msg_id INTEGER NOT NULL)"
+        )
+        self.db.commit()
+
+    def push(self, destination, user_id, pair_name, source_chat, message_ids, queued_time, clone_job=None):
+        """Record a message, or an album given as a list of message IDs.
+
+        Messages queued by a clone job move its checkpoint in the same transaction instead of the pair's
+        catch-up point, so a resumed clone never queues a message twice.
+        """
+        album_ids = ",".join(map(str, message_ids)) if isinstance(message_ids, list) else None
+        message_id = message_ids[0] if isinstance(message_ids, list) else message_ids
+        cursor = self.db.execute(
+            "INSERT INTO queue (destination, user_id, pair_name, source_chat, message_id, queued_at, album_ids)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (destination, user_id, pair_name, source_chat, message_id, queued_time.isoformat(), album_ids)
+        )
+        last_msg_id = max(message_ids) if isinstance(message_ids, list) else message_ids
+        if clone_job is not None:
+            self.db.execute("UPDATE clone_jobs SET last_msg_id = ? WHERE job_id = ?", (last_msg_id, clone_job))
+        else:
+            self.db.execute(
+                "INSERT INTO pair_progress VALUES (?, ?, ?, ?) ON CONFLICT (user_id, pair_name) DO UPDATE SET"
+                " last_msg_id = max(last_msg_id, excluded.last_msg_id), source_chat = excluded.source_chat",
+                (user_id, pair_name, source_chat, last_msg_id)
+            )
+        self.db.commit()
+        return cursor.lastrowid
+
+    def progress(self):
+        """(user_id, pair_name) -> (source chat, highest source message ID queued for the pair)."""
+        return {
+            (user_id, pair_name): (source_chat, last_msg_id)
+            for user_id, pair_name, source_chat, last_msg_id in self.db.execute("SELECT * FROM pair_progress")
+        }
+
+    def forget_progress(self, user_id, pair_name):
+        """Drop a pair's catch-up point, so it only picks up messages that arrive from now on."""
+        self.db.execute("DELETE FROM pair_progress WHERE user_id = ? AND pair_name = ?", (user_id, pair_name))
+        self.db.commit()
+
+    def start_clone(self, user_id, pair_name, source_chat, first_msg_id, end_msg_id):
+        """Record a new clone job and return its ID."""
+        cursor = self.db.execute(
+            "INSERT INTO clone_jobs (user_id, pair_name, source_chat, first_msg_id, end_msg_id, last_msg_id)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, pair_name, source_chat, first_msg_id, end_msg_id, first_msg_id - 1)
+        )
+        self.db.commit()
+        return cursor.lastrowid
+
+    def clone_jobs(self):
+        """Unfinished clone jobs as (job_id, user_id, pair_name, source_chat, first_msg_id, end_msg_id, last_msg_id)."""
+        return self.db.execute("SELECT * FROM clone_jobs ORDER BY job_id").fetchall()
+
+    def finish_clone(self, job_id):
+        self.db.execute("DELETE FROM clone_jobs WHERE job_id = ?", (job_id,))
+        self.db.commit()
+
+    def ack(self, *seqs):
+        """Remove delivered messages."""
+        self.db.executemany("DELETE FROM queue WHERE seq = ?", [(seq,) for seq in seqs])
+        self.db.commit()
+
+    def fail(self, *seqs):
+        """Keep messages that exhausted their retries out of replay without losing them."""
+        self.db.executemany("UPDATE queue SET failed = 1 WHERE seq = ?", [(seq,) for seq in seqs])
+        self.db.commit()
+
+    def load(self, destination, after_seq, limit):
+        return self.db.execute(
+            "SELECT seq, user_id, pair_name, source_chat, message_id, queued_at, album_ids FROM queue"
+            " WHERE destination = ? AND failed = 0 AND seq > ? ORDER BY seq LIMIT ?",
+            (destination, after_seq, limit)
+        ).fetchall()
+
+    def destinations(self):
+        return [row[0] for row in self.db.execute("SELECT DISTINCT destination FROM queue WHERE failed = 0")]
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM queue WHERE failed = 0").fetchone()[0]
+
+    def count_failed(self):
+        return self.db.execute("SELECT COUNT(*) FROM queue WHERE failed = 1").fetchone()[0]
+
+    def retry_failed(self):
+        """Requeue failed messages at the back of their lanes; returns their destinations."""
+        destinations = [row[0] for row in self.db.execute("SELECT DISTINCT destination FROM queue WHERE failed = 1")]
+        with self.db:
+            self.db.execute(
+                "INSERT INTO queue (destination, user_id, pair_name, source_chat, message_id, queued_at, album_ids)"
+                " SELECT destination, user_id, pair_name, source_chat, message_id, queued_at, album_ids"
+                " FROM queue WHERE failed = 1 ORDER BY seq"
+            )
+            self.db.execute("DELETE FROM queue WHERE failed = 1")
+        return destinations
+
+    def prune_failed(self, days):
+        """Drop failed messages queued more than the given number of days ago."""
+        cutoff = datetime.fromtimestamp(time.time() - days * 86400).isoformat()
+        with self.db:
+            return self.db.execute("DELETE FROM queue WHERE failed = 1 AND queued_at < ?", (cutoff,)).rowcount
+
+class LRUCache:
+    """Small least-recently-used cache on top of OrderedDict."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        try:
+            self.data.move_to_end(key)
+        except KeyError:
+            return default
+        return self.data[key]
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+class TTLCache(LRUCache):
+    """LRU cache whose entries also expire after a fixed number of seconds."""
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = super().get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            self.pop(key)
+            return default
+        return value
+
+    def put(self, key, value):
+        super().put(key, (value, time.monotonic() + self.ttl))
+
+photo_hash_cache = TTLCache(PHOTO_HASH_CACHE_SIZE, PHOTO_HASH_CACHE_TTL)
+reply_targets = TTLCache(REPLY_CACHE_SIZE, REPLY_CACHE_TTL)  # mapping key -> destination message ID, 0 if not found
+recently_queued = LRUCache(RECENTLY_QUEUED_SIZE)  # (user_id, pair_name, source chat ID, source message ID) -> True
+
+def input_peer(chat_id):
+    """The cached InputPeer for a chat, or its ID for Telethon to resolve if none is cached yet."""
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        return chat_id  # a username, never cached
+    return input_peers.get(chat_id, chat_id)
+
+async def resolve_peer(chat_id):
+    """Resolve a chat's InputPeer and cache it."""
+    chat_id = int(chat_id)
+    try:
+        await rate_limiter.acquire('get_messages')
+        input_peers[chat_id] = await client.get_input_entity(chat_id)
+    except errors.FloodWaitError as e:
+        rate_limiter.record_flood_wait('get_messages', None, e.seconds)
+    except Exception as e:
+        logger.warning(f"Could not resolve chat {chat_id}: {e}")
+        input_peers.pop(chat_id, None)
+
+def refresh_peer(chat_id):
+    """Re-resolve a chat's InputPeer in the background, e.g. after its access hash was rejected."""
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        logger.warning(f"Chat '{chat_id}' is not numeric; its peer is not cached")
+        return
+    if chat_id not in peer_refreshes:
+        task = peer_refreshes[chat_id] = asyncio.create_task(resolve_peer(chat_id))
+        task.add_done_callback(lambda _: peer_refreshes.pop(chat_id, None))
+
+def pair_chats():
+    """Every numeric source and destination chat ID used by a pair."""
+    chats = set()
+    for pairs in channel_mappings.values():
+        for mapping in pairs.values():
+            for side in ('source', 'destination'):
+                try:
+                    chats.add(int(mapping[side]))
+                except (TypeError, ValueError):
+                    pass
+    return chats
+
+async def refresh_input_peers():
+    """Resolve every pair's chats at startup, then keep them fresh in the background."""
+    while True:
+        if is_connected:
+            try:
+                chats = pair_chats()
+                await asyncio.gather(*(resolve_peer(chat_id) for chat_id in chats))
+                for chat_id in set(input_peers) - chats:
+                    del input_peers[chat_id]
+                logger.info(f"Resolved {len(input_peers)} of {len(chats)} pair chat(s)")
+            except Exception as e:
+                logger.error(f"Error refreshing pair chat peers: {e}")
+            await asyncio.sleep(PEER_REFRESH_INTERVAL)
+        else:
+            await asyncio.sleep(5)
+
+def message_key(mapping, source_msg_id):
+    """Key of a forwarded message in the ID mapping store."""
+    return (int(mapping['source']), source_msg_id, int(mapping['destination']))
+
+class MessageStore:
+    """Persistent source->destination message ID map with an LRU front cache and write-behind."""
+
+    def __init__(self, path):
+        self.db = open_state_db(path)
+        # WITHOUT ROWID clusters rows on the primary key, so lookups are served by the key alone
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS message_map ("
+            " source_chat INTEGER NOT NULL,"
+            " source_msg INTEGER NOT NULL,"
+            " dest_chat INTEGER NOT NULL,"
+            " dest_msg INTEGER NOT NULL,"
+            " pair_key TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " content_hash INTEGER,"
+            " PRIMARY KEY (source_chat, source_msg, dest_chat)) WITHOUT ROWID"
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(message_map)")]
+        if 'content_hash' not in columns:
+            self.db.execute("ALTER TABLE message_map ADD COLUMN content_hash INTEGER")
+        self.db.execute("CREATE INDEX IF NOT EXISTS message_map_pair ON message_map (pair_key, created_at)")
+        self.db.commit()
+        self.cache = LRUCache(MAPPING_CACHE_SIZE)  # key -> (dest_msg, content_hash)
+        self.pending = {}  # key -> row to write, or None for a pending delete
+        self.pending_hashes = {}  # key -> content hash to update on an already written row
+
+    def get_entry(self, key):
+        """Return (dest_msg, content_hash) for a (source_chat, source_msg, dest_chat) key, or None."""
+        if key in self.pending:
+            row = self.pending[key]
+            return (row[3], row[6]) if row else None
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry
+        row = self.db.execute(
+            "SELECT dest_msg, content_hash FROM message_map WHERE source_chat = ? AND source_msg = ? AND dest_chat = ?",
+            key
+        ).fetchone()
+        if row:
+            entry = (row[0], self.pending_hashes.get(key, row[1]))
+            self.cache.put(key, entry)
+            return entry
+        return None
+
+    def warm(self, pair_keys, per_pair):
+        """Load the most recent mappings of each pair into the cache."""
+        for pair_key in pair_keys:
+            rows = self.db.execute(
+                "SELECT source_chat, source_msg, dest_chat, dest_msg, content_hash FROM message_map"
+                " WHERE pair_key = ? ORDER BY created_at DESC LIMIT ?",
+                (pair_key, per_pair)
+            ).fetchall()
+            for source_chat, source_msg, dest_chat, dest_msg, content_hash in reversed(rows):
+                self.cache.put((source_chat, source_msg, dest_chat), (dest_msg, content_hash))
+
+    def get(self, key):
+        """Return the destination message ID for a (source_chat, source_msg, dest_chat) key."""
+        entry = self.get_entry(key)
+        return entry[0] if entry else None
+
+    def get_many(self, source_chat, source_msgs, dest_chat):
+        """Look up several messages of one source chat for one destination; returns {source_msg: dest_msg}."""
+        found, missing = {}, []
+        for source_msg in source_msgs:
+            key = (source_chat, source_msg, dest_chat)
+            if key in self.pending:
+                row = self.pending[key]
+                if row:
+                    found[source_msg] = row[3]
+                continue
+            entry = self.cache.get(key)
+            if entry is not None:
+                found[source_msg] = entry[0]
+            else:
+                missing.append(source_msg)
+        # Stay well below SQLite's bound-parameter limit
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            found.update(self.db.execute(
+                "SELECT source_msg, dest_msg FROM message_map WHERE source_chat = ? AND dest_chat = ?"
+                f" AND source_msg IN ({','.join('?' * len(chunk))})",
+                (source_chat, dest_chat, *chunk)
+            ))
+        return found
+
+    def put(self, key, dest_msg, pair_key, content_hash=None):
+        self.cache.put(key, (dest_msg, content_hash))
+        self.pending[key] = (*key, dest_msg, pair_key, time.time(), content_hash)
+        self.pending_hashes.pop(key, None)
+        if len(self.pending) >= MAPPING_FLUSH_BATCH:
+            self.flush()
+
+    def put_many(self, entries, pair_key):
+        """Record several (key, dest_msg, content_hash) entries at once."""
+        for key, dest_msg, content_hash in entries:
+            self.cache.put(key, (dest_msg, content_hash))
+            self.pending[key] = (*key, dest_msg, pair_key, time.time(), content_hash)
+            self.pending_hashes.pop(key, None)
+        if len(self.pending) >= MAPPING_FLUSH_BATCH:
+            self.flush()
+
+    def set_hash(self, key, content_hash):
+        """Remember the content last sent for a mapped message, so unchanged edits can be skipped."""
+        row = self.pending.get(key)
+        if row:
+            self.pending[key] = (*row[:6], content_hash)
+        elif key not in self.pending:
+            self.pending_hashes[key] = content_hash
+        if key in self.cache:
+            self.cache.put(key, (self.cache.get(key)[0], content_hash))
+
+    def delete(self, key):
+        self.cache.pop(key)
+        self.pending[key] = None
+        self.pending_hashes.pop(key, None)
+
+    def flush(self):
+        """Write pending inserts, hash updates and deletes in one transaction."""
+        if not self.pending and not self.pending_hashes:
+            return
+        pending, self.pending = self.pending, {}
+        hashes, self.pending_hashes = self.pending_hashes, {}
+        rows = [row for row in pending.values() if row]
+        deletes = [key for key, row in pending.items() if row is None]
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO message_map"
+                " (source_chat, source_msg, dest_chat, dest_msg, pair_key, created_at, content_hash)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self.db.executemany(
+                "UPDATE message_map SET content_hash = ? WHERE source_chat = ? AND source_msg = ? AND dest_chat = ?",
+                [(content_hash, *key) for key, content_hash in hashes.items()]
+            )
+            self.db.executemany(
+                "DELETE FROM message_map WHERE source_chat = ? AND source_msg = ? AND dest_chat = ?", deletes
+            )
+
+    def prune(self, pair_key, max_age_days, max_count):
+        """Apply a pair's retention limits; returns the number of rows removed."""
+        self.flush()
+        with self.db:
+            removed = self.db.execute(
+                "DELETE FROM message_map WHERE pair_key = ? AND created_at < ?",
+                (pair_key, time.time() - max_age_days * 86400)
+            ).rowcount
+            removed += self.db.execute(
+                "DELETE FROM message_map WHERE pair_key = ? AND created_at < ("
+                " SELECT created_at FROM message_map WHERE pair_key = ?"
+                " ORDER BY created_at DESC LIMIT 1 OFFSET ?)",
+                (pair_key, pair_key, max_count - 1)
+            ).rowcount
+        return removed
+
+class PairConfigStore:
+    """Pair configurations as one JSON row per (user, pair), so a save rewrites only changed pairs.
+
+    Writes run in a worker thread, one at a time, hence the connection is not bound to a thread.
+    """
+
+    def __init__(self, path):
+        self.db = open_state_db(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pair_config ("
+            " user_id TEXT NOT NULL,"
+            " pair_name TEXT NOT NULL,"
+            " config TEXT NOT NULL,"
+            " PRIMARY KEY (user_id, pair_name)) WITHOUT ROWID"
+        )
+        self.db.commit()
+        self.written = {}  # (user_id, pair_name) -> config JSON as last written
+
+    def load(self):
+        mappings = {}
+        for user_id, pair_name, config in self.db.execute("SELECT user_id, pair_name, config FROM pair_config"):
+            mappings.setdefault(user_id, {})[pair_name] = json.loads(config)
+            self.written[(user_id, pair_name)] = config
+        return mappings
+
+    def write(self, snapshot):
+        """Bring the table in line with a {(user_id, pair_name): config JSON} snapshot."""
+        changed = [(*key, config) for key, config in snapshot.items() if self.written.get(key) != config]
+        removed = [key for key in self.written if key not in snapshot]
+        if not changed and not removed:
+            return 0
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO pair_config VALUES (?, ?, ?)", changed)
+            self.db.executemany("DELETE FROM pair_config WHERE user_id = ? AND pair_name = ?", removed)
+        self.written = dict(snapshot)
+        return len(changed) + len(removed)
+
+class RingSeries:
+    """Counts of each METRIC_COUNTERS entry over the last `size` buckets of `width` seconds."""
+
+    __slots__ = ('width', 'size', 'stamps', 'counts')
+
+    def __init__(self, width, size):
+        self.width = width
+        self.size = size
+        self.stamps = array('q', [-1]) * size  # bucket number currently held by each slot
+        self.counts = array('I', [0]) * (size * len(METRIC_COUNTERS))
+
+    def _slot(self, bucket):
+        slot = bucket % self.size
+        if self.stamps[slot] != bucket:
+            self.stamps[slot] = bucket
+            start = slot * len(METRIC_COUNTERS)
+            self.counts[start:start + len(METRIC_COUNTERS)] = array('I', [0]) * len(METRIC_COUNTERS)
+        return slot
+
+    def add(self, counter, count, now):
+        """Add to a counter in the bucket covering `now`; returns that bucket number."""
+        bucket = int(now // self.width)
+        self.counts[self._slot(bucket) * len(METRIC_COUNTERS) + counter] += count
+        return bucket
+
+    def row(self, bucket):
+        """All counters of a bucket, or None once it has been overwritten."""
+        slot = bucket % self.size
+        if self.stamps[slot] != bucket:
+            return None
+        start = slot * len(METRIC_COUNTERS)
+        return self.counts[start:start + len(METRIC_COUNTERS)].tolist()
+
+    def load(self, bucket, values):
+        start = self._slot(bucket) * len(METRIC_COUNTERS)
+        self.counts[start:start + len(METRIC_COUNTERS)] = array('I', values)
+
+    def totals(self, buckets, now):
+        """Counter name -> sum over the last `buckets` buckets, the current one included."""
+        current = int(now // self.width)
+        sums = [0] * len(METRIC_COUNTERS)
+        for bucket in range(current - min(buckets, self.size) + 1, current + 1):
+            row = self.row(bucket)
+            if row:
+                sums = [total + value for total, value in zip(sums, row)]
+        return dict(zip(METRIC_COUNTERS, sums))
+
+class MetricsStore:
+    """Per-pair counters in fixed time buckets, persisted with the all-time totals in pair_stats.
+
+    Rows with width 0 hold a pair's all-time totals; other rows hold one bucket of a METRIC_SERIES.
+    """
+
+    def __init__(self, path):
+        self.db = open_state_db(path)
+        columns = ", ".join(f"{counter} INTEGER NOT NULL" for counter in METRIC_COUNTERS)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pair_metrics ("
+            " user_id TEXT NOT NULL,"
+            " pair_name TEXT NOT NULL,"
+            " width INTEGER NOT NULL,"
+            " bucket INTEGER NOT NULL,"
+            f" {columns},"
+            " last_activity TEXT,"
+            " PRIMARY KEY (user_id, pair_name, width, bucket)) WITHOUT ROWID"
+        )
+        self.db.commit()
+        self.series = {}  # (user_id, pair_name) -> [RingSeries per METRIC_SERIES entry]
+        self.dirty = set()  # (user_id, pair_name, width, bucket) rows to write; width 0 for totals
+
+    def _series(self, user_id, pair_name):
+        series = self.series.get((user_id, pair_name))
+        if series is None:
+            series = self.series[(user_id, pair_name)] = [RingSeries(width, size) for width, size in METRIC_SERIES]
+        return series
+
+    def record(self, user_id, pair_name, counter, count=1):
+        now = time.time()
+        counter = METRIC_COUNTERS.index(counter)
+        for ring in self._series(user_id, pair_name):
+            self.dirty.add((user_id, pair_name, ring.width, ring.add(counter, count, now)))
+        self.dirty.add((user_id, pair_name, 0, 0))
+
+    def window(self, user_id, pair_name, width, buckets):
+        """Counter totals of a pair over the last `buckets` buckets of the series with this width."""
+        for ring in self._series(user_id, pair_name):
+            if ring.width == width:
+                return ring.totals(buckets, time.time())
+        raise ValueError(f"No metric series with {width}s buckets")
+
+    def restore(self):
+        """Load persisted totals into pair_stats and recent buckets into the ring series."""
+        now = time.time()
+        for user_id, pair_name, width, bucket, *values, last_activity in self.db.execute("SELECT * FROM pair_metrics"):
+            if width == 0:
+                stats = pair_stats.get(user_id, {}).get(pair_name)
+                if stats is not None:
+                    stats.update(zip(METRIC_COUNTERS, values))
+                    stats['last_activity'] = last_activity
+                continue
+            for ring in self._series(user_id, pair_name):
+                if ring.width == width and bucket > int(now // width) - ring.size:
+                    ring.load(bucket, values)
+
+    def reset(self, user_id, pair_name):
+        """Forget a pair's history, e.g. when the pair is replaced or removed."""
+        self.series.pop((user_id, pair_name), None)
+        self.dirty = {row for row in self.dirty if row[:2] != (user_id, pair_name)}
+        with self.db:
+            self.db.execute("DELETE FROM pair_metrics WHERE user_id = ? AND pair_name = ?", (user_id, pair_name))
+
+    def flush(self):
+        """Write changed buckets and totals, and drop buckets that fell out of their series."""
+        dirty, self.dirty = self.dirty, set()
+        rows = []
+        for user_id, pair_name, width, bucket in dirty:
+            if width == 0:
+                stats = pair_stats.get(user_id, {}).get(pair_name)
+                if stats is not None:
+                    rows.append((user_id, pair_name, 0, 0, *(stats.get(counter, 0) for counter in METRIC_COUNTERS), stats['last_activity']))
+                continue
+            for ring in self._series(user_id, pair_name):
+                values = ring.row(bucket) if ring.width == width else None
+                if values:
+                    rows.append((user_id, pair_name, width, bucket, *values, None))
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO pair_metrics VALUES ({', '.join('?' * (len(METRIC_COUNTERS) + 5))})", rows
+            )
+            for width, size in METRIC_SERIES:
+                self.db.execute(
+                    "DELETE FROM pair_metrics WHERE width = ? AND bucket <= ?", (width, int(now // width) - size)
+                )
+
+class LatencyHistogram:
+    """HDR-style latency histogram: log-linear buckets with about 6% relative precision."""
+
+    __slots__ = ('counts', 'total', 'max')
+
+    def __init__(self):
+        self.counts = array('I', [0]) * LATENCY_BUCKETS
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def _index(micros):
+        # Exact below 32us, then 16 buckets per power of two
+        if micros < 32:
+            return micros
+        shift = micros.bit_length() - 5
+        return min((shift + 1) * 16 + (micros >> shift) - 16, LATENCY_BUCKETS - 1)
+
+    @staticmethod
+    def _upper(index):
+        """Largest value, in microseconds, that falls in a bucket."""
+        if index < 32:
+            return index
+        shift = index // 16 - 1
+        return ((index % 16 + 17) << shift) - 1
+
+    def record(self, seconds):
+        micros = max(int(seconds * 1_000_000), 0)
+        self.counts[self._index(micros)] += 1
+        self.total += 1
+        if micros > self.max:
+            self.max = micros
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Latency in seconds below which `percent` of the samples fall."""
+        target = max(self.total * percent / 100, 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._upper(index), self.max) / 1_000_000
+        return self.max / 1_000_000
+
+def record_latency(user_id, pair_name, stage, seconds):
+    histogram = latency_histograms.get((user_id, pair_name, stage))
+    if histogram is None:
+        histogram = latency_histograms[(user_id, pair_name, stage)] = LatencyHistogram()
+    histogram.record(seconds)
+
+@contextmanager
+def timed(user_id, pair_name, stage):
+    """Record how long the enclosed block takes as one sample of a pair's stage latency."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_latency(user_id, pair_name, stage, time.perf_counter() - started)
+
+def reset_latency(user_id, pair_name):
+    for key in [key for key in latency_histograms if key[:2] == (user_id, pair_name)]:
+        del latency_histograms[key]
+
+def empty_pair_stats():
+    """Counters for a pair with no activity yet."""
+    return {**dict.fromkeys(METRIC_COUNTERS, 0), 'last_activity': None}
+
+def format_error_rate(stats):
+    """Share of send attempts that failed, from a counters dict."""
+    attempts = stats['forwarded'] + stats['failed']
+    return f"{stats['failed'] / attempts:.1%}" if attempts else "n/a"
+
+def record_stat(user_id, pair_name, counter, count=1):
+    """Count pair activity in both the all-time pair_stats and the time-bucketed metrics."""
+    stats = pair_stats.get(user_id, {}).get(pair_name)
+    if stats is not None:
+        stats[counter] += count
+    if metrics is not None:
+        metrics.record(user_id, pair_name, counter, count)
+
+class SourceMessage:
+    """A source message as fanned out to every pair that forwards it.
+
+    Holds only what forwarding needs, without the Telethon event, client or raw update, so deep
+    queues stay small. The same instance is queued for all pairs, so text rendering runs once per
+    distinct filter configuration instead of once per pair.
+    """
+
+    __slots__ = (
+        'chat_id', 'id', 'raw_text', 'entities', 'media', 'reply_to', 'silent', 'grouped_id', 'queued_at', 'rendered'
+    )
+
+    def __init__(self, chat_id, msg_id, raw_text, entities, media, reply_to, silent, grouped_id, queued_at=None):
+        self.chat_id = chat_id
+        self.id = msg_id
+        self.raw_text = raw_text
+        self.entities = entities
+        self.media = media
+        self.reply_to = reply_to  # source message ID this one replies to, or None
+        self.silent = silent
+        self.grouped_id = grouped_id
+        self.queued_at = time.monotonic() if queued_at is None else queued_at
+        self.rendered = None  # text filter signature -> (text, entities, block_reason), once rendered
+
+    @classmethod
+    def from_message(cls, message, chat_id=None, queued_at=None):
+        return cls(
+            chat_id if chat_id is not None else message.chat_id,
+            message.id,
+            message.raw_text,
+            message.entities,
+            message.media,
+            message.reply_to.reply_to_msg_id if message.reply_to else None,
+            message.silent,
+            message.grouped_id,
+            queued_at
+        )
+
+    def render(self, mapping, filters):
+        """Render the text through a pair's filters, reusing the result of any pair with the same config."""
+        if self.rendered is None:
+            self.rendered = {}
+        result = self.rendered.get(filters.text_signature)
+        if result is None:
+            result = self.rendered[filters.text_signature] = render_message_text(
+                self.raw_text, self.entities or [], mapping, filters
+            )
+        return result
+
+def queue_depth():
+    """Total number of messages waiting in all destination lanes, in memory or on disk."""
+    if durable_queue:
+        return durable_queue.count()
+    return sum(len(lane.items) for lane in send_lanes.values())
+
+def get_lane(destination):
+    """Return the lane for a destination, starting its worker if needed."""
+    lane = send_lanes.get(destination)
+    if lane is None:
+        lane = send_lanes[destination] = DestinationLane(destination)
+    if lane.task is None or lane.task.done():
+        lane.task = asyncio.create_task(lane_worker(lane))
+    return lane
+
+def enqueue_message(event, mapping, user_id, pair_name, queued_time, clone_job=None):
+    """Persist a message (or an album, given as a list of events) and append it to its destination lane.
+
+    Messages spill to disk instead of memory once the lane is full. Returns False, without queuing,
+    for a message already queued for the pair, e.g. one seen both live and by catch-up. History
+    queued by a clone job skips that check, which would otherwise evict the recent live keys.
+    """
+    if isinstance(event, list):
+        source_chat, message_ids = event[0].chat_id, [album_event.id for album_event in event]
+    else:
+        source_chat, message_ids = event.chat_id, event.id
+    if clone_job is None:
+        key = (user_id, pair_name, source_chat, message_ids[0] if isinstance(message_ids, list) else message_ids)
+        if key in recently_queued:
+            return False
+        recently_queued.put(key, True)
+    destination = int(mapping['destination'])
+    lane = get_lane(destination)
+    seq = durable_queue.push(destination, user_id, pair_name, source_chat, message_ids, queued_time, clone_job)
+    # Once anything has spilled, newer messages stay on disk too so the lane keeps its order
+    if lane.spilled or len(lane.items) >= MAX_QUEUE_SIZE:
+        lane.spilled = True
+    else:
+        lane.items.append((event, mapping, user_id, pair_name, queued_time, seq))
+        lane.last_seq = seq
+    lane.wakeup.set()
+    return True
+
+async def refill_lane(lane):
+    """Load the next spilled messages of a lane from disk, refetching them from their source chats.
+
+    The lane stays spilled until the loaded rows are in memory, so messages queued while the refetch
+    is in flight go to disk behind them instead of jumping ahead. Rows from a source that can no
+    longer be read are marked failed rather than retried, which would hold up the whole lane.
+    """
+    rows = durable_queue.load(lane.destination, lane.last_seq, MAX_QUEUE_SIZE)
+    if not rows:
+        lane.spilled = False
+        return
+
+    ids_by_source = {}
+    for _, user_id, pair_name, source_chat, message_id, _, album_ids in rows:
+        if pair_name in channel_mappings.get(user_id, {}):
+            message_ids = [int(i) for i in album_ids.split(',')] if album_ids else [message_id]
+            ids_by_source.setdefault(source_chat, []).extend(message_ids)
+    messages = {}
+    unreadable = set()
+    for source_chat, message_ids in ids_by_source.items():
+        await rate_limiter.acquire('get_messages')
+        try:
+            fetched = await client.get_messages(input_peer(source_chat), ids=message_ids)
+        except (errors.FloodWaitError, errors.ServerError):
+            raise
+        except errors.RPCError as e:
+            logger.error(f"Cannot refetch queued messages from {source_chat}: {e}; marking them failed")
+            if isinstance(e, PEER_ERRORS):
+                refresh_peer(source_chat)
+            unreadable.add(source_chat)
+            continue
+        for message in fetched:
+            if message:
+                messages[(source_chat, message.id)] = message
+
+    for seq, user_id, pair_name, source_chat, message_id, queued_at, album_ids in rows:
+        mapping = channel_mappings.get(user_id, {}).get(pair_name)
+        if mapping and source_chat in unreadable:
+            durable_queue.fail(seq)
+            record_stat(user_id, pair_name, 'failed', len(album_ids.split(',')) if album_ids else 1)
+            continue
+        queued_time = datetime.fromisoformat(queued_at)
+        # Carry the original wait over into this process's monotonic clock
+        queued_mono = time.monotonic() - (datetime.now() - queued_time).total_seconds()
+        if album_ids:
+            event = [
+                SourceMessage.from_message(messages[(source_chat, int(i))], source_chat, queued_mono)
+                for i in album_ids.split(',') if (source_chat, int(i)) in messages
+            ]
+        else:
+            message = messages.get((source_chat, message_id))
+            event = SourceMessage.from_message(message, source_chat, queued_mono) if message else None
+        if not mapping or not event:
+            logger.warning(f"Dropping queued message {source_chat}:{message_id} for pair '{pair_name}': pair or message no longer exists")
+            durable_queue.ack(seq)
+            continue
+        lane.items.append((event, mapping, user_id, pair_name, queued_time, seq))
+    lane.last_seq = rows[-1][0]
+    if len(rows) < MAX_QUEUE_SIZE and not durable_queue.load(lane.destination, lane.last_seq, 1):
+        lane.spilled = False
+
+def resume_queued_messages():
+    """Restart lanes for messages left undelivered by a previous run.
+
+    Runs before connecting, so the backlog is ahead of any live message. A lane that already exists
+    is reloaded from the start of the queue, since its memory may hold items newer than the backlog.
+    """
+    destinations = durable_queue.destinations()
+    for destination in destinations:
+        lane = get_lane(destination)
+        lane.items.clear()
+        lane.last_seq = 0
+        lane.spilled = True
+        lane.wakeup.set()
+    if destinations:
+        logger.info(f"Replaying {durable_queue.count()} undelivered message(s) across {len(destinations)} lane(s)")
 
 def save_mappings():
-    """Save channel mappings to file."""
+    """Schedule a write of channel mappings; changes within CONFIG_SAVE_DELAY are written together."""
+    global config_dirty, config_save_task
+    config_dirty = True
+    if config_save_task is None or config_save_task.done():
+        config_save_task = asyncio.create_task(write_mappings_later())
+
+async def write_mappings_later():
+    """Write channel mappings off the event loop until no further changes are pending."""
+    global config_dirty
+    while config_dirty:
+        await asyncio.sleep(CONFIG_SAVE_DELAY)
+        config_dirty = False
+        try:
+            await asyncio.to_thread(write_mappings, snapshot_mappings(), next(config_generations))
+        except Exception as e:
+            logger.error(f"Error saving mappings: {e}")
+
+def snapshot_mappings():
+    """Serialize channel mappings on the event loop, so the worker thread never sees them mid-change."""
+    if config_store is not None:
+        return {
+            (user_id, pair_name): json.dumps(mapping)
+            for user_id, pairs in channel_mappings.items()
+            for pair_name, mapping in pairs.items()
+        }
+    return json.dumps(channel_mappings)
+
+def write_mappings(snapshot, generation):
+    """Persist a snapshot from snapshot_mappings(); safe to call from a worker thread.
+
+    Writes are serialized, and a snapshot older than the one already written is skipped.
+    """
+    global config_written
+    with config_write_lock:
+        if generation < config_written:
+            return
+        if config_store is not None:
+            changed = config_store.write(snapshot)
+            logger.info(f"Channel mappings saved ({changed} pair(s) changed).")
+        else:
+            # Write a temp file and rename it over the old one, so a crash never leaves a truncated file
+            temp_file = MAPPINGS_FILE + ".tmp"
+            with open(temp_file, "w") as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, MAPPINGS_FILE)
+            if hasattr(os, 'O_DIRECTORY'):
+                dir_fd = os.open(os.path.dirname(os.path.abspath(MAPPINGS_FILE)), os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            logger.info("Channel mappings saved to file.")
+        config_written = generation
+
+def save_mappings_now():
+    """Write channel mappings synchronously, after any write still running in the save task's thread; used on shutdown."""
+    global config_dirty
+    config_dirty = False
+    if config_save_task is not None:
+        config_save_task.cancel()
     try:
-        with open(MAPPINGS_FILE, "w") as f:
-            json.dump(channel_mappings, f)
-        logger.info("Channel mappings saved to file.")
+        write_mappings(snapshot_mappings(), next(config_generations))
     except Exception as e:
         logger.error(f"Error saving mappings: {e}")
 
 def load_mappings():
     """Load channel mappings from file and initialize stats."""
-    global channel_mappings
+    global channel_mappings, config_store
     try:
-        with open(MAPPINGS_FILE, "r") as f:
-            channel_mappings = json.load(f)
-        logger.info(f"Loaded {sum(len(v) for v in channel_mappings.values())} mappings from file.")
+        if CONFIG_BACKEND == "sqlite":
+            config_store = PairConfigStore(STATE_DB_FILE)
+            channel_mappings = config_store.load()
+        if not channel_mappings:
+            with open(MAPPINGS_FILE, "r") as f:
+                channel_mappings = json.load(f)
+            if config_store is not None:
+                # Migrate the JSON file into the SQLite backend, then retire it so clearing every pair
+                # later does not bring its pairs back on the next start
+                write_mappings(snapshot_mappings(), next(config_generations))
+                os.replace(MAPPINGS_FILE, MAPPINGS_FILE + ".migrated")
+                logger.info(f"Migrated {MAPPINGS_FILE} into {STATE_DB_FILE}; the old file is kept as {MAPPINGS_FILE}.migrated")
+        logger.info(f"Loaded {sum(len(v) for v in channel_mappings.values())} mappings.")
         for user_id, pairs in channel_mappings.items():
             if user_id not in pair_stats:
                 pair_stats[user_id] = {}
             for pair_name in pairs:
-                pair_stats[user_id][pair_name] = {
-                    'forwarded': 0, 'edited': 0, 'deleted': 0, 'blocked': 0, 'queued': 0, 'last_activity': None
-                }
+                pair_stats[user_id][pair_name] = empty_pair_stats()
+        rebuild_source_index()
     except FileNotFoundError:
         logger.info("No existing mappings file found. Starting fresh.")
     except Exception as e:
         logger.error(f"Error loading mappings: {e}")
 
+def unindex_pair(user_id, pair_name):
+    """Remove a pair from the source-chat index."""
+    source_id = indexed_pairs.pop((user_id, pair_name), None)
+    if source_id is None:
+        return
+    entries = [entry for entry in source_index.get(source_id, []) if entry[:2] != (user_id, pair_name)]
+    if entries:
+        source_index[source_id] = entries
+    else:
+        source_index.pop(source_id, None)
+
+def index_pair(user_id, pair_name):
+    """Add or refresh a pair in the source-chat index; paused pairs are left out."""
+    unindex_pair(user_id, pair_name)
+    mapping = channel_mappings.get(user_id, {}).get(pair_name)
+    if not mapping or not mapping['active']:
+        return
+    try:
+        source_id = int(mapping['source'])
+    except (TypeError, ValueError):
+        logger.warning(f"Pair '{pair_name}' has a non-numeric source '{mapping['source']}'; not indexed")
+        return
+    # Rebuild the list instead of appending so in-flight iterations keep a stable snapshot
+    source_index[source_id] = source_index.get(source_id, []) + [(user_id, pair_name, mapping)]
+    indexed_pairs[(user_id, pair_name)] = source_id
+
+def unindex_user(user_id):
+    """Remove every pair of a user from the source-chat index."""
+    for indexed_user_id, pair_name in list(indexed_pairs):
+        if indexed_user_id == user_id:
+            unindex_pair(indexed_user_id, pair_name)
+
+def rebuild_source_index():
+    """Rebuild the source-chat index from channel_mappings."""
+    source_index.clear()
+    indexed_pairs.clear()
+    for user_id, pairs in channel_mappings.items():
+        for pair_name in pairs:
+            index_pair(user_id, pair_name)
+    logger.info(f"Source index built: {len(indexed_pairs)} active pairs across {len(source_index)} source chats")
+
+class AhoCorasick:
+    """Multi-pattern matcher that finds every occurrence of a set of strings in one pass."""
+
+    def __init__(self, patterns):
+        self.patterns = [pattern for pattern in dict.fromkeys(patterns) if pattern]
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = next_state
+            self.output[state] += (index,)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def finditer(self, text):
+        """Yield (start, end, pattern) for every match, ordered by end position."""
+        goto, fail, output, patterns = self.goto, self.fail, self.output, self.patterns
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for index in output[state]:
+                pattern = patterns[index]
+                yield position + 1 - len(pattern), position + 1, pattern
+
+    def search(self, text):
+        """Return the first pattern found in text, or None."""
+        for _, _, pattern in self.finditer(text):
+            return pattern
+        return None
+
+    def replace(self, text, replacement):
+        """Replace every match, preferring the leftmost and then the longest overlapping one."""
+        spans = sorted((start, -end) for start, end, _ in self.finditer(text))
+        if not spans:
+            return text
+        parts = []
+        position = 0
+        for start, negative_end in spans:
+            if start < position:
+                continue
+            parts.append(text[position:start])
+            parts.append(replacement)
+            position = -negative_end
+        parts.append(text[position:])
+        return "".join(parts)
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """BK-tree over 64-bit perceptual hashes for sub-linear Hamming-distance lookups."""
+
+    def __init__(self, values=()):
+        self.root = None  # (value, {distance: child node})
+        self.size = 0
+        for value in values:
+            self.add(value)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value):
+        if self.root is None:
+            self.root = (value, {})
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(node[0], value)
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (value, {})
+                self.size += 1
+                return
+            node = child
+
+    def find(self, value, threshold):
+        """Return (stored value, distance) of the closest value within threshold, or None."""
+        best = None
+        stack = [self.root] if self.root else []
+        while stack:
+            node_value, children = stack.pop()
+            distance = hamming_distance(node_value, value)
+            if distance <= threshold and (best is None or distance < best[1]):
+                best = (node_value, distance)
+                if distance == 0:
+                    break
+            # Triangle inequality: only subtrees within threshold of this distance can hold a match
+            for child_distance, child in children.items():
+                if distance - threshold <= child_distance <= distance + threshold:
+                    stack.append(child)
+        return best
+
+def filter_signature(mapping):
+    """Hashable description of a pair's text filters and custom text."""
+    return (
+        tuple(mapping.get('blacklist') or ()),
+        tuple(mapping.get('blocked_sentences') or ()),
+        bool(mapping.get('block_urls', False)),
+        tuple(mapping.get('blacklist_urls') or ()),
+        mapping.get('header_pattern', ''),
+        mapping.get('footer_pattern', ''),
+        bool(mapping.get('remove_mentions', False)),
+        mapping.get('custom_header', ''),
+        mapping.get('custom_footer', ''),
+    )
+
+class CompiledFilters:
+    """A pair's blacklist, blocked sentences, URL blacklist and blocked images compiled into matchers."""
+
+    def __init__(self, mapping, text_signature):
+        self.text_signature = text_signature
+        self.blacklist = AhoCorasick(mapping.get('blacklist') or [])
+        self.blocked_sentences = AhoCorasick([s.lower() for s in mapping.get('blocked_sentences') or []])
+        self.blacklist_urls = AhoCorasick(mapping.get('blacklist_urls') or [])
+        self.blocked_images = BKTree(int(h, 16) for h in mapping.get('blocked_image_hashes') or [])
+        self.image_threshold = mapping.get('image_hash_threshold', IMAGE_HASH_THRESHOLD)
+
+    def match_image(self, image_hash):
+        """Return (blocked hash, distance) if a hex image hash is close to a blocked one, else None."""
+        match = self.blocked_images.find(int(image_hash, 16), self.image_threshold)
+        if match is None:
+            return None
+        return f"{match[0]:016x}", match[1]
+
+shared_filters = LRUCache(FILTER_SHARE_CACHE_SIZE)  # full filter signature -> CompiledFilters
+
+def get_compiled_filters(user_id, pair_name, mapping):
+    """Return the cached compiled filters of a pair, compiling them on first use.
+
+    Pairs with identical filter configurations share one CompiledFilters instance.
+    """
+    filters = compiled_filters.get((user_id, pair_name))
+    if filters is None:
+        text_signature = filter_signature(mapping)
+        signature = (
+            text_signature,
+            tuple(mapping.get('blocked_image_hashes') or ()),
+            mapping.get('image_hash_threshold', IMAGE_HASH_THRESHOLD),
+        )
+        filters = shared_filters.get(signature)
+        if filters is None:
+            filters = CompiledFilters(mapping, text_signature)
+            shared_filters.put(signature, filters)
+        compiled_filters[(user_id, pair_name)] = filters
+    return filters
+
+def invalidate_filters(user_id, pair_name=None):
+    """Drop compiled filters after a pair's filter lists change (all of a user's pairs if no name)."""
+    if pair_name is not None:
+        compiled_filters.pop((user_id, pair_name), None)
+        return
+    for key in [key for key in compiled_filters if key[0] == user_id]:
+        del compiled_filters[key]
+
 def filter_blacklisted_words(text, blacklist):
     """Replace blacklisted words with asterisks."""
     if not text or not blacklist:
         return text
-    for word in blacklist:
-        text = text.replace(word, "***")
-    return text
+    return blacklist.replace(text, "***")
 
 def check_blocked_sentences(text, blocked_sentences):
     """Check if text contains blocked sentences."""
     if not text or not blocked_sentences:
         return False, None
-    for sentence in blocked_sentences:
-        if sentence.lower() in text.lower():
-            return True, sentence
+    sentence = blocked_sentences.search(text.lower())
+    if sentence is not None:
+        return True, sentence
     return False, None
 
 def filter_urls(text, block_urls, blacklist_urls=None):
     """Filter or block URLs in text."""
     if not text or not block_urls:
         return text, True
-    url_pattern = r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+(?:/[^\s]*)?'
-    urls = re.findall(url_pattern, text)
     if blacklist_urls:
-        for url in urls:
-            if any(blacklisted in url for blacklisted in blacklist_urls):
-                text = text.replace(url, '[URL BLOCKED]')
-        return text, True
+        return URL_PATTERN.sub(
+            lambda match: '[URL BLOCKED]' if blacklist_urls.search(match.group(0)) else match.group(0), text
+        ), True
     else:
-        text = re.sub(url_pattern, '[URL REMOVED]', text)
+        text = URL_PATTERN.sub('[URL REMOVED]', text)
         return text, False
 
 def remove_header_footer(text, header_pattern, footer_pattern):
@@ -132,6 +1532,142 @@ def apply_custom_header_footer(text, custom_header, custom_footer):
         result = f"{result.rstrip()}\n{custom_footer}"
     return result.strip()
 
+def _release_hash_slot(future):
+    if not future.cancelled():
+        future.exception()  # retrieved here, as a caller that timed out never awaits it
+    hash_slots.release()
+
+async def _hash_in_pool(data):
+    """Hash in the pool; the slot stays taken until the job finishes, even if the caller stops waiting."""
+    await hash_slots.acquire()
+    try:
+        future = asyncio.get_running_loop().run_in_executor(hash_pool, compute_image_hash, data)
+    except BaseException:
+        hash_slots.release()
+        raise
+    future.add_done_callback(_release_hash_slot)
+    return await asyncio.shield(future)
+
+async def hash_image(data):
+    """Hash image bytes off the event loop; returns None if the pool is saturated past HASH_TIMEOUT or fails."""
+    try:
+        return await asyncio.wait_for(_hash_in_pool(data), HASH_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Image hashing timed out after {HASH_TIMEOUT}s")
+    except Exception as e:
+        logger.error(f"Image hashing failed: {e}")
+    return None
+
+def pick_hash_thumb(photo):
+    """Pick the smallest photo size that is still large enough for a stable pHash."""
+    sizes = [
+        size for size in getattr(photo, 'sizes', None) or []
+        if not isinstance(size, (PhotoStrippedSize, PhotoPathSize)) and getattr(size, 'w', 0) and getattr(size, 'h', 0)
+    ]
+    if not sizes:
+        return None
+    usable = [size for size in sizes if max(size.w, size.h) >= PHASH_MIN_SIZE]
+    if usable:
+        return min(usable, key=lambda size: size.w * size.h)
+    return max(sizes, key=lambda size: size.w * size.h)
+
+async def _download_and_hash_photo(message):
+    thumb = pick_hash_thumb(message.media.photo)
+    data = await client.download_media(message.media, bytes, thumb=thumb)
+    if not data:
+        return None
+    return await hash_image(data)
+
+async def get_photo_hash(message):
+    """Perceptual hash of a message's photo, cached by photo so reposts and edits are hashed once."""
+    photo = message.media.photo
+    if getattr(photo, 'id', None) is None:
+        return await _download_and_hash_photo(message)
+    key = (photo.id, photo.access_hash)
+    image_hash = photo_hash_cache.get(key)
+    if image_hash is not None:
+        return image_hash
+    task = photo_hash_tasks.get(key)
+    if task is None:
+        task = photo_hash_tasks[key] = asyncio.ensure_future(_download_and_hash_photo(message))
+        task.add_done_callback(lambda _: photo_hash_tasks.pop(key, None))
+    image_hash = await asyncio.shield(task)
+    if image_hash is not None:
+        photo_hash_cache.put(key, image_hash)
+    return image_hash
+
+def render_message_text(raw_text, entities, mapping, filters):
+    """Apply a pair's text filters and custom header/footer to a message text.
+
+    Returns (text, entities, block_reason); block_reason is set when the message must not be forwarded.
+    Entities are dropped whenever the text was changed, since their offsets no longer line up.
+    """
+    message_text = raw_text or ""
+    if not message_text:
+        return message_text, entities, None
+
+    if mapping.get('blocked_sentences'):
+        should_block, matching_sentence = check_blocked_sentences(message_text, filters.blocked_sentences)
+        if should_block:
+            return message_text, entities, f"blocked sentence: '{matching_sentence}'"
+
+    if mapping.get('blacklist'):
+        message_text = filter_blacklisted_words(message_text, filters.blacklist)
+        if message_text.strip() == "***":
+            return message_text, entities, "blacklist filter"
+
+    if mapping.get('block_urls', False) or mapping.get('blacklist_urls'):
+        message_text, _ = filter_urls(message_text, mapping.get('block_urls', False), filters.blacklist_urls)
+
+    if mapping.get('header_pattern') or mapping.get('footer_pattern'):
+        message_text = remove_header_footer(
+            message_text, mapping.get('header_pattern', ''), mapping.get('footer_pattern', '')
+        )
+
+    if mapping.get('remove_mentions', False):
+        message_text = MENTION_PATTERN.sub('', message_text)
+        message_text = WHITESPACE_PATTERN.sub(' ', message_text).strip()
+
+    message_text = apply_custom_header_footer(
+        message_text, mapping.get('custom_header', ''), mapping.get('custom_footer', '')
+    )
+    if message_text != raw_text:
+        entities = None
+    return message_text, entities, None
+
+def render_hash(text, entities, media):
+    """Fingerprint the text, entities and media a forwarded message was sent with."""
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update((text or "").encode('utf-8', 'surrogatepass'))
+    for entity in entities or []:
+        digest.update(bytes(entity))
+    media_obj = getattr(media, 'photo', None) or getattr(media, 'document', None)
+    if media_obj is not None:
+        digest.update(b'\0' + str(media_obj.id).encode())
+    return int.from_bytes(digest.digest(), 'big', signed=True)
+
+def is_passthrough(mapping):
+    """True if a pair never rewrites text, so its messages can be forwarded server-side unchanged.
+
+    Pairs whose source turned out to restrict forwarding (protected content) are never passthrough.
+    """
+    return not (
+        mapping.get('forwards_restricted', False)
+        or mapping.get('blacklist') or mapping.get('block_urls', False)
+        or mapping.get('header_pattern') or mapping.get('footer_pattern')
+        or mapping.get('custom_header') or mapping.get('custom_footer')
+        or mapping.get('remove_mentions', False)
+    )
+
+def sent_ids_from_updates(updates, random_ids):
+    """Map the random_id of each message in a batched request to the ID Telegram assigned it."""
+    assigned = {
+        update.random_id: update.id
+        for update in getattr(updates, 'updates', [])
+        if isinstance(update, UpdateMessageID)
+    }
+    return [assigned.get(random_id) for random_id in random_ids]
+
 async def send_split_message(client, entity, message_text, reply_to=None, silent=False, entities=None):
     """Send long messages in parts if they exceed Telegram's limit."""
     if len(message_text) <= MAX_MESSAGE_LENGTH:
@@ -168,82 +1704,50 @@ def extract_message_from_updates(updates):
 
 async def forward_message_with_retry(event, mapping, user_id, pair_name):
     """Forward a message with retries and filtering."""
-    source_msg_id = event.message.id if hasattr(event.message, 'id') else "Unknown"
+    source_msg_id = event.id
     for attempt in range(MAX_RETRIES):
         try:
-            message_text = event.message.raw_text or ""
-            original_entities = event.message.entities or []
-            media = event.message.media
-            reply_to = await handle_reply_mapping(event, mapping)
-
-            if message_text:
-                if mapping.get('blocked_sentences'):
-                    should_block, matching_sentence = check_blocked_sentences(message_text, mapping['blocked_sentences'])
-                    if should_block:
-                        logger.info(f"Message blocked due to blocked sentence: '{matching_sentence}'")
-                        pair_stats[user_id][pair_name]['blocked'] += 1
-                        return True
-
-                if mapping.get('blacklist'):
-                    message_text = filter_blacklisted_words(message_text, mapping['blacklist'])
-                    if message_text.strip() == "***":
-                        logger.info("Message entirely blocked due to blacklist filter")
-                        pair_stats[user_id][pair_name]['blocked'] += 1
-                        return True
-
-                if mapping.get('block_urls', False) or mapping.get('blacklist_urls'):
-                    message_text, allow_preview = filter_urls(
-                        message_text,
-                        mapping.get('block_urls', False),
-                        mapping.get('blacklist_urls')
-                    )
-                    if message_text != event.message.raw_text:
-                        original_entities = None
-
-                if mapping.get('header_pattern') or mapping.get('footer_pattern'):
-                    message_text = remove_header_footer(
-                        message_text, mapping.get('header_pattern', ''), mapping.get('footer_pattern', '')
-                    )
-                    if message_text != event.message.raw_text:
-                        original_entities = None
-
-                if mapping.get('remove_mentions', False):
-                    message_text = re.sub(r'@[a-zA-Z0-9_]+|\[([^\]]+)\]\(tg://user\?id=\d+\)', '', message_text)
-                    message_text = re.sub(r'\s+', ' ', message_text).strip()
-                    if message_text != event.message.raw_text:
-                        original_entities = None
+            media = event.media
+            with timed(user_id, pair_name, 'reply'):
+                reply_to = await handle_reply_mapping(event, mapping)
+            filters = get_compiled_filters(user_id, pair_name, mapping)
+
+            with timed(user_id, pair_name, 'filter'):
+                message_text, original_entities, block_reason = event.render(mapping, filters)
+            if block_reason:
+                logger.info(f"Message blocked due to {block_reason}")
+                record_stat(user_id, pair_name, 'blocked')
+                return True
 
-                message_text = apply_custom_header_footer(
-                    message_text, mapping.get('custom_header', ''), mapping.get('custom_footer', '')
-                )
-                if message_text != event.message.raw_text:
-                    original_entities = None
+            if isinstance(media, MessageMediaPhoto) and mapping.get('blocked_image_hashes'):
+                with timed(user_id, pair_name, 'phash'):
+                    image_hash = await get_photo_hash(event)
+                if image_hash is None:
+                    logger.warning(f"Forwarding without image check for pair '{pair_name}' (Source Msg ID: {source_msg_id})")
+                elif (match := filters.match_image(image_hash)):
+                    blocked_hash, distance = match
+                    logger.info(f"Image blocked: hash {image_hash} is {distance} bit(s) from blocked hash {blocked_hash}")
+                    record_stat(user_id, pair_name, 'blocked')
+                    return True
 
+            send_started = time.perf_counter()
             if media:
                 if isinstance(media, MessageMediaPhoto):
-                    if mapping.get('blocked_image_hashes'):
-                        photo = await client.download_media(event.message, bytes)
-                        image = Image.open(io.BytesIO(photo))
-                        image_hash = str(imagehash.phash(image))
-                        if image_hash in mapping['blocked_image_hashes']:
-                            logger.info(f"Image blocked due to matching perceptual hash: {image_hash}")
-                            pair_stats[user_id][pair_name]['blocked'] += 1
-                            return True
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         file=media,
                         message=message_text,
                         reply_to=reply_to,
-                        silent=event.message.silent,
+                        silent=event.silent,
                         formatting_entities=original_entities if original_entities else None
                     )
                 elif isinstance(media, MessageMediaDocument):
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         file=media,
                         message=message_text,
                         reply_to=reply_to,
-                        silent=event.message.silent,
+                        silent=event.silent,
                         formatting_entities=original_entities if original_entities else None
                     )
                 elif isinstance(media, MessageMediaPoll):
@@ -262,11 +1766,11 @@ async def forward_message_with_retry(event, mapping, user_id, pair_name):
                     )
                     reply_to_obj = InputReplyToMessage(reply_to_msg_id=reply_to) if reply_to else None
                     sent_message = await client(SendMediaRequest(
-                        peer=int(mapping['destination']),
+                        peer=input_peer(mapping['destination']),
                         media=input_media_poll,
                         message=message_text,
                         reply_to=reply_to_obj,
-                        silent=event.message.silent,
+                        silent=event.silent,
                         entities=original_entities if original_entities else None
                     ))
                     sent_message = extract_message_from_updates(sent_message)
@@ -275,138 +1779,149 @@ async def forward_message_with_retry(event, mapping, user_id, pair_name):
                         return False
                 elif isinstance(media, MessageMediaGeo):
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         message=message_text or "Location",
                         geo=media,
                         reply_to=reply_to,
-                        silent=event.message.silent
+                        silent=event.silent
                     )
                 elif isinstance(media, MessageMediaContact):
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         message=message_text or "Contact",
                         contact=media,
                         reply_to=reply_to,
-                        silent=event.message.silent
+                        silent=event.silent
                     )
                 elif isinstance(media, MessageMediaVenue):
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         message=message_text or f"Venue: {media.title}",
                         geo=media,
                         reply_to=reply_to,
-                        silent=event.message.silent
+                        silent=event.silent
                     )
                 elif isinstance(media, MessageMediaWebPage):
-                    has_links = any(isinstance(e, (MessageEntityTextUrl, MessageEntityUrl)) for e in original_entities)
+                    has_links = any(isinstance(e, (MessageEntityTextUrl, MessageEntityUrl)) for e in original_entities or [])
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         message=message_text,
                         link_preview=True if has_links else False,
                         reply_to=reply_to,
-                        silent=event.message.silent,
+                        silent=event.silent,
                         formatting_entities=original_entities if original_entities else None
                     )
                 elif isinstance(media, MessageMediaDice):
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         message=message_text or f"Dice: {media.emoticon}",
                         dice=media,
                         reply_to=reply_to,
-                        silent=event.message.silent
+                        silent=event.silent
                     )
                 elif isinstance(media, MessageMediaGame):
                     logger.info("Games cannot be forwarded directly; sending text only")
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         message=message_text or f"Game: {media.game.title}",
                         reply_to=reply_to,
-                        silent=event.message.silent
+                        silent=event.silent
                     )
                 elif isinstance(media, MessageMediaInvoice):
                     logger.info("Invoices cannot be forwarded; sending text only")
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         message=message_text or f"Invoice: {media.title}",
                         reply_to=reply_to,
-                        silent=event.message.silent
+                        silent=event.silent
                     )
                 elif isinstance(media, MessageMediaGeoLive):
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         message=message_text or "Live Location",
                         geo=media,
                         reply_to=reply_to,
-                        silent=event.message.silent
+                        silent=event.silent
                     )
                 elif isinstance(media, MessageMediaStory):
                     logger.info("Stories cannot be forwarded directly; sending text only")
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         message=message_text or "Story",
                         reply_to=reply_to,
-                        silent=event.message.silent
+                        silent=event.silent
                     )
                 else:
                     logger.warning(f"Unsupported media type: {type(media).__name__}")
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         message=message_text or "Unsupported media type",
                         reply_to=reply_to,
-                        silent=event.message.silent
+                        silent=event.silent
                     )
             else:
                 if not message_text.strip():
                     logger.info("Message skipped: empty text with no media")
-                    pair_stats[user_id][pair_name]['blocked'] += 1
+                    record_stat(user_id, pair_name, 'blocked')
                     return True
                 if len(message_text) > MAX_MESSAGE_LENGTH:
                     sent_message = await send_split_message(
                         client,
-                        int(mapping['destination']),
+                        input_peer(mapping['destination']),
                         message_text,
                         reply_to=reply_to,
-                        silent=event.message.silent,
+                        silent=event.silent,
                         entities=original_entities
                     )
                 else:
                     sent_message = await client.send_message(
-                        entity=int(mapping['destination']),
+                        entity=input_peer(mapping['destination']),
                         message=message_text,
                         reply_to=reply_to,
-                        silent=event.message.silent,
+                        silent=event.silent,
                         formatting_entities=original_entities if original_entities else None
                     )
 
-            await store_message_mapping(event, mapping, sent_message)
-            pair_stats[user_id][pair_name]['forwarded'] += 1
+            record_latency(user_id, pair_name, 'send', time.perf_counter() - send_started)
+            await store_message_mapping(
+                event, mapping, sent_message, user_id, pair_name,
+                render_hash(message_text, original_entities, media)
+            )
+            record_stat(user_id, pair_name, 'forwarded')
             pair_stats[user_id][pair_name]['last_activity'] = datetime.now().isoformat()
-            logger.info(f"Message forwarded from {mapping['source']} to {mapping['destination']} (ID: {sent_message.id})")
+            logger.info(
+                "Message forwarded from %s to %s (ID: %s)", mapping['source'], mapping['destination'], sent_message.id,
+                extra=sampled(pair_name)
+            )
             return True
 
-        except errors.FloodWaitError as e:
-            wait_time = e.seconds
-            logger.warning(f"Flood wait error, sleeping for {wait_time} seconds for pair '{pair_name}' (Source Msg ID: {source_msg_id})")
-            await asyncio.sleep(wait_time)
+        except errors.FloodWaitError:
+            # Flood waits are fed to the rate limiter by the destination lane so other lanes keep sending
+            raise
         except errors.MessageTooLongError:
             logger.warning(f"Message too long; splitting and retrying for pair '{pair_name}' (Source Msg ID: {source_msg_id})")
             sent_message = await send_split_message(
                 client,
-                int(mapping['destination']),
+                input_peer(mapping['destination']),
                 message_text,
                 reply_to=reply_to,
-                silent=event.message.silent,
+                silent=event.silent,
                 entities=original_entities
             )
             if sent_message:
-                await store_message_mapping(event, mapping, sent_message)
-                pair_stats[user_id][pair_name]['forwarded'] += 1
+                await store_message_mapping(event, mapping, sent_message, user_id, pair_name)
+                record_stat(user_id, pair_name, 'forwarded')
                 pair_stats[user_id][pair_name]['last_activity'] = datetime.now().isoformat()
-                logger.info(f"Long message forwarded from {mapping['source']} to {mapping['destination']} (ID: {sent_message.id})")
+                logger.info(
+                    "Long message forwarded from %s to %s (ID: %s)", mapping['source'], mapping['destination'], sent_message.id,
+                    extra=sampled(pair_name)
+                )
                 return True
             return False
         except (errors.RPCError, ConnectionError) as e:
             logger.warning(f"Attempt {attempt + 1} failed for pair '{pair_name}' (Source Msg ID: {source_msg_id}): {e}")
+            if isinstance(e, PEER_ERRORS):
+                refresh_peer(mapping['destination'])
             if attempt < MAX_RETRIES - 1:
                 await asyncio.sleep(RETRY_DELAY)
             else:
@@ -422,180 +1937,391 @@ async def forward_message_with_retry(event, mapping, user_id, pair_name):
                 await client.send_message(NOTIFY_CHAT_ID, error_msg)
             return False
 
-async def edit_forwarded_message(event, mapping, user_id, pair_name):
-    """Edit a forwarded message based on source changes."""
-    try:
-        mapping_key = f"{mapping['source']}:{event.message.id}"
-        if not hasattr(client, 'forwarded_messages'):
-            logger.warning("No forwarded_messages attribute found on client")
-            return
-        if mapping_key not in client.forwarded_messages:
-            logger.warning(f"No mapping found for message: {mapping_key}")
-            return
+async def forward_album_with_retry(events, mapping, user_id, pair_name):
+    """Forward an album as one media group, filtering each item on its own.
 
-        forwarded_msg_id = client.forwarded_messages[mapping_key]
-        forwarded_msg = await client.get_messages(int(mapping['destination']), ids=forwarded_msg_id)
-        if not forwarded_msg:
-            logger.warning(f"Forwarded message {forwarded_msg_id} not found in destination {mapping['destination']}")
-            del client.forwarded_messages[mapping_key]
-            return
+    Albums that cannot be grouped are sent item by item, each taking its own send token. Sent items
+    are dropped from the queued album, so a flood wait part-way through resumes with the rest.
+    """
+    source_ids = [event.id for event in events]
+    if not all(isinstance(event.media, (MessageMediaPhoto, MessageMediaDocument)) for event in events):
+        logger.info(f"Album {source_ids} has items that cannot be grouped; forwarding them one by one")
+        results = []
+        while True:
+            results.append(await forward_message_with_retry(events[0], mapping, user_id, pair_name))
+            if len(events) == 1:
+                return all(results)
+            events.pop(0)
+            await rate_limiter.acquire('send', int(mapping['destination']))
+
+    filters = get_compiled_filters(user_id, pair_name, mapping)
+    for attempt in range(MAX_RETRIES):
+        try:
+            kept = []
+            for event in events:
+                with timed(user_id, pair_name, 'filter'):
+                    caption, entities, block_reason = event.render(mapping, filters)
+                if not block_reason and isinstance(event.media, MessageMediaPhoto) and mapping.get('blocked_image_hashes'):
+                    with timed(user_id, pair_name, 'phash'):
+                        image_hash = await get_photo_hash(event)
+                    if image_hash is not None and filters.match_image(image_hash):
+                        block_reason = f"blocked image hash {image_hash}"
+                if block_reason:
+                    logger.info(f"Album item {event.id} blocked due to {block_reason}")
+                    record_stat(user_id, pair_name, 'blocked')
+                    continue
+                kept.append((event, caption, entities))
 
-        message_text = event.message.raw_text or ""
-        original_entities = event.message.entities or []
-        media = event.message.media
+            if not kept:
+                return True
+            if len(kept) == 1:
+                return await forward_message_with_retry(kept[0][0], mapping, user_id, pair_name)
+
+            with timed(user_id, pair_name, 'reply'):
+                reply_to = await handle_reply_mapping(events[0], mapping)
+            random_ids = [helpers.generate_random_long() for _ in kept]
+            multi_media = [
+                InputSingleMedia(
+                    media=utils.get_input_media(event.media),
+                    random_id=random_id,
+                    message=caption,
+                    entities=entities or None
+                )
+                for (event, caption, entities), random_id in zip(kept, random_ids)
+            ]
+            with timed(user_id, pair_name, 'send'):
+                updates = await client(SendMultiMediaRequest(
+                    peer=input_peer(mapping['destination']),
+                    multi_media=multi_media,
+                    reply_to=InputReplyToMessage(reply_to_msg_id=reply_to) if reply_to else None,
+                    silent=events[0].silent
+                ))
+
+            for (event, caption, entities), sent_id in zip(kept, sent_ids_from_updates(updates, random_ids)):
+                if sent_id is not None:
+                    message_store.put(
+                        message_key(mapping, event.id), sent_id, f"{user_id}:{pair_name}",
+                        render_hash(caption, entities, event.media)
+                    )
+            record_stat(user_id, pair_name, 'forwarded', len(kept))
+            pair_stats[user_id][pair_name]['last_activity'] = datetime.now().isoformat()
+            logger.info(
+                "Album of %d item(s) forwarded from %s to %s", len(kept), mapping['source'], mapping['destination'],
+                extra=sampled(pair_name)
+            )
+            return True
 
-        if isinstance(media, MessageMediaPhoto) and mapping.get('blocked_image_hashes'):
-            photo = await client.download_media(event.message, bytes)
-            image = Image.open(io.BytesIO(photo))
-            image_hash = str(imagehash.phash(image))
-            if image_hash in mapping['blocked_image_hashes']:
-                await client.delete_messages(int(mapping['destination']), [forwarded_msg_id])
-                logger.info(f"Forwarded message {forwarded_msg_id} deleted due to blocked image hash: {image_hash}")
-                pair_stats[user_id][pair_name]['blocked'] += 1
-                pair_stats[user_id][pair_name]['deleted'] += 1
-                return
+        except errors.FloodWaitError:
+            raise
+        except (errors.RPCError, ConnectionError) as e:
+            logger.warning(f"Attempt {attempt + 1} failed for album {source_ids} on pair '{pair_name}': {e}")
+            if isinstance(e, PEER_ERRORS):
+                refresh_peer(mapping['destination'])
+            if attempt < MAX_RETRIES - 1:
+                await asyncio.sleep(RETRY_DELAY)
+            else:
+                error_msg = f"❌ Failed to forward album for pair '{pair_name}' (Source Msg IDs: {source_ids}) after {MAX_RETRIES} attempts. Error: {e}"
+                logger.error(error_msg)
+                if NOTIFY_CHAT_ID:
+                    await client.send_message(NOTIFY_CHAT_ID, error_msg)
+                return False
+        except Exception as e:
+            error_msg = f"⚠️ Unexpected error forwarding album for pair '{pair_name}' (Source Msg IDs: {source_ids}): {e}"
+            logger.error(error_msg, exc_info=True)
+            if NOTIFY_CHAT_ID:
+                await client.send_message(NOTIFY_CHAT_ID, error_msg)
+            return False
 
-        if mapping.get('blocked_sentences'):
-            should_block, matching_sentence = check_blocked_sentences(message_text, mapping['blocked_sentences'])
-            if should_block:
-                await client.delete_messages(int(mapping['destination']), [forwarded_msg_id])
-                logger.info(f"Forwarded message {forwarded_msg_id} deleted due to blocked sentence: '{matching_sentence}'")
-                pair_stats[user_id][pair_name]['blocked'] += 1
-                pair_stats[user_id][pair_name]['deleted'] += 1
-                return
+def take_forward_batch(lane):
+    """Collect the lane's leading run of items that can go out in one server-side forward.
 
-        if mapping.get('blacklist') and message_text:
-            message_text = filter_blacklisted_words(message_text, mapping['blacklist'])
-            if message_text.strip() == "***":
-                await client.delete_messages(int(mapping['destination']), [forwarded_msg_id])
-                logger.info(f"Forwarded message {forwarded_msg_id} deleted due to blacklist filter")
-                pair_stats[user_id][pair_name]['blocked'] += 1
-                pair_stats[user_id][pair_name]['deleted'] += 1
-                return
+    Items qualify when they belong to the same passthrough pair, share the silent flag and carry no
+    reply to re-thread; the run stops at MAX_FORWARD_BATCH message IDs. Returns [] if the head item
+    does not qualify.
+    """
+    batch = []
+    id_count = 0
+    for item in lane.items:
+        event, mapping, user_id, pair_name = item[:4]
+        item_events = event if isinstance(event, list) else [event]
+        silent = item_events[0].silent
+        if not batch:
+            if not is_passthrough(mapping):
+                break
+            head = (user_id, pair_name, silent)
+        elif (user_id, pair_name, silent) != head:
+            break
+        if any(item_event.reply_to for item_event in item_events):
+            break
+        if id_count + len(item_events) > MAX_FORWARD_BATCH:
+            break
+        batch.append(item)
+        id_count += len(item_events)
+    return batch
+
+async def forward_batch_with_retry(batch, mapping, user_id, pair_name):
+    """Forward queued messages of a passthrough pair with one ForwardMessagesRequest (drop_author).
+
+    Returns None, leaving the batch queued, if the source refuses server-side forwards; the pair is
+    then no longer passthrough and the lane resends the items one by one.
+    """
+    messages = []
+    for item in batch:
+        messages.extend(item[0] if isinstance(item[0], list) else [item[0]])
+    source_ids = [message.id for message in messages]
+    filters = get_compiled_filters(user_id, pair_name, mapping)
 
-        if mapping.get('block_urls', False) or mapping.get('blacklist_urls'):
-            message_text, _ = filter_urls(
-                message_text, 
-                mapping.get('block_urls', False), 
-                mapping.get('blacklist_urls')
-            )
-            if message_text != event.message.raw_text:
-                original_entities = None
+    for attempt in range(MAX_RETRIES):
+        try:
+            kept = []
+            for message in messages:
+                with timed(user_id, pair_name, 'filter'):
+                    should_block, matching_sentence = check_blocked_sentences(message.raw_text, filters.blocked_sentences)
+                if not should_block and isinstance(message.media, MessageMediaPhoto) and mapping.get('blocked_image_hashes'):
+                    with timed(user_id, pair_name, 'phash'):
+                        image_hash = await get_photo_hash(message)
+                    should_block = image_hash is not None and bool(filters.match_image(image_hash))
+                if should_block:
+                    logger.info(f"Message {message.id} blocked by pair '{pair_name}' filters")
+                    record_stat(user_id, pair_name, 'blocked')
+                    continue
+                kept.append(message)
+            if not kept:
+                return True
 
-        if (mapping.get('header_pattern') or mapping.get('footer_pattern')) and message_text:
-            message_text = remove_header_footer(
-                message_text, mapping.get('header_pattern', ''), mapping.get('footer_pattern', '')
+            random_ids = [helpers.generate_random_long() for _ in kept]
+            with timed(user_id, pair_name, 'send'):
+                updates = await client(ForwardMessagesRequest(
+                    from_peer=input_peer(mapping['source']),
+                    id=[message.id for message in kept],
+                    to_peer=input_peer(mapping['destination']),
+                    random_id=random_ids,
+                    silent=kept[0].silent,
+                    drop_author=True
+                ))
+            sent_ids = sent_ids_from_updates(updates, random_ids)
+            message_store.put_many(
+                [
+                    (
+                        message_key(mapping, message.id), sent_id,
+                        render_hash(message.raw_text, message.entities, message.media)
+                    )
+                    for message, sent_id in zip(kept, sent_ids) if sent_id is not None
+                ],
+                f"{user_id}:{pair_name}"
+            )
+            record_stat(user_id, pair_name, 'forwarded', len(kept))
+            pair_stats[user_id][pair_name]['last_activity'] = datetime.now().isoformat()
+            logger.info(
+                "Batch of %d message(s) forwarded from %s to %s", len(kept), mapping['source'], mapping['destination'],
+                extra=sampled(pair_name)
             )
-            if message_text != event.message.raw_text:
-                original_entities = None
-
-        if mapping.get('remove_mentions', False) and message_text:
-            message_text = re.sub(r'@[a-zA-Z0-9_]+|\[([^\]]+)\]\(tg://user\?id=\d+\)', '', message_text)
-            message_text = re.sub(r'\s+', ' ', message_text).strip()
-            if message_text != event.message.raw_text:
-                original_entities = None
-
-        if not message_text.strip() and not media:
-            await client.delete_messages(int(mapping['destination']), [forwarded_msg_id])
-            logger.info(f"Forwarded message {forwarded_msg_id} deleted: empty after filtering")
-            pair_stats[user_id][pair_name]['blocked'] += 1
-            pair_stats[user_id][pair_name]['deleted'] += 1
+            return True
+
+        except errors.FloodWaitError:
+            raise
+        except errors.ChatForwardsRestrictedError:
+            logger.warning(f"Source {mapping['source']} of pair '{pair_name}' restricts forwarding; sending its messages individually")
+            mapping['forwards_restricted'] = True
+            save_mappings()
+            return None
+        except (errors.RPCError, ConnectionError) as e:
+            logger.warning(f"Attempt {attempt + 1} failed for batch {source_ids[0]}..{source_ids[-1]} on pair '{pair_name}': {e}")
+            if isinstance(e, PEER_ERRORS):
+                refresh_peer(mapping['destination'])
+            if attempt < MAX_RETRIES - 1:
+                await asyncio.sleep(RETRY_DELAY)
+            else:
+                error_msg = f"❌ Failed to forward batch for pair '{pair_name}' (Source Msg IDs: {source_ids[0]}..{source_ids[-1]}) after {MAX_RETRIES} attempts. Error: {e}"
+                logger.error(error_msg)
+                if NOTIFY_CHAT_ID:
+                    await client.send_message(NOTIFY_CHAT_ID, error_msg)
+                return False
+        except Exception as e:
+            error_msg = f"⚠️ Unexpected error forwarding batch for pair '{pair_name}' (Source Msg IDs: {source_ids[0]}..{source_ids[-1]}): {e}"
+            logger.error(error_msg, exc_info=True)
+            if NOTIFY_CHAT_ID:
+                await client.send_message(NOTIFY_CHAT_ID, error_msg)
+            return False
+
+async def edit_forwarded_message(event, mapping, user_id, pair_name):
+    """Edit a forwarded message based on source changes; event is a SourceMessage."""
+    mapping_key = message_key(mapping, event.id)
+    entry = message_store.get_entry(mapping_key)
+    if entry is None:
+        logger.warning(f"No mapping found for message: {mapping_key}")
+        return
+    forwarded_msg_id, stored_hash = entry
+    destination = int(mapping['destination'])
+
+    try:
+        media = event.media
+        filters = get_compiled_filters(user_id, pair_name, mapping)
+
+        delete_reason = None
+        if isinstance(media, MessageMediaPhoto) and mapping.get('blocked_image_hashes'):
+            with timed(user_id, pair_name, 'phash'):
+                image_hash = await get_photo_hash(event)
+            match = filters.match_image(image_hash) if image_hash is not None else None
+            if match:
+                delete_reason = f"blocked image hash: {match[0]} (distance {match[1]})"
+
+        with timed(user_id, pair_name, 'filter'):
+            message_text, original_entities, block_reason = event.render(mapping, filters)
+        if not delete_reason and block_reason:
+            delete_reason = block_reason
+        if not delete_reason and not message_text.strip() and not media:
+            delete_reason = "empty after filtering"
+
+        if delete_reason:
+            await rate_limiter.acquire('delete', destination)
+            await client.delete_messages(input_peer(destination), [forwarded_msg_id])
+            message_store.delete(mapping_key)
+            logger.info(f"Forwarded message {forwarded_msg_id} deleted due to {delete_reason}")
+            record_stat(user_id, pair_name, 'blocked')
+            record_stat(user_id, pair_name, 'deleted')
             return
 
-        message_text = apply_custom_header_footer(
-            message_text, mapping.get('custom_header', ''), mapping.get('custom_footer', '')
-        )
-        if message_text != event.message.raw_text:
-            original_entities = None
+        content_hash = render_hash(message_text, original_entities, media)
+        if content_hash == stored_hash:
+            logger.debug(f"Edit of source message {event.id} does not change forwarded message {forwarded_msg_id}; skipped")
+            return
 
         if isinstance(media, MessageMediaPoll):
             logger.info(f"Poll message {forwarded_msg_id} cannot be edited; deleting and resending")
-            await client.delete_messages(int(mapping['destination']), [forwarded_msg_id])
-            del client.forwarded_messages[mapping_key]
+            await rate_limiter.acquire('delete', destination)
+            await client.delete_messages(input_peer(destination), [forwarded_msg_id])
+            message_store.delete(mapping_key)
             await forward_message_with_retry(event, mapping, user_id, pair_name)
             return
 
-        await client.edit_message(
-            entity=int(mapping['destination']),
-            message=forwarded_msg_id,
-            text=message_text,
-            file=media if media and isinstance(media, (MessageMediaPhoto, MessageMediaDocument)) else None,
-            formatting_entities=original_entities if original_entities else None
-        )
-        pair_stats[user_id][pair_name]['edited'] += 1
+        await rate_limiter.acquire('edit', destination)
+        with timed(user_id, pair_name, 'edit'):
+            await client.edit_message(
+                entity=input_peer(destination),
+                message=forwarded_msg_id,
+                text=message_text,
+                file=media if media and isinstance(media, (MessageMediaPhoto, MessageMediaDocument)) else None,
+                formatting_entities=original_entities if original_entities else None
+            )
+        rate_limiter.record_success('edit', destination)
+        message_store.set_hash(mapping_key, content_hash)
+        record_stat(user_id, pair_name, 'edited')
         pair_stats[user_id][pair_name]['last_activity'] = datetime.now().isoformat()
-        logger.info(f"Forwarded message {forwarded_msg_id} edited in {mapping['destination']}")
+        logger.info("Forwarded message %s edited in %s", forwarded_msg_id, mapping['destination'], extra=sampled(pair_name))
 
+    except errors.MessageNotModifiedError:
+        message_store.set_hash(mapping_key, content_hash)
     except errors.MessageAuthorRequiredError:
         logger.error(f"Cannot edit message {forwarded_msg_id}: Bot must be the original author")
     except errors.MessageIdInvalidError:
-        logger.error(f"Cannot edit message {forwarded_msg_id}: Message ID is invalid or deleted")
-        if mapping_key in client.forwarded_messages:
-            del client.forwarded_messages[mapping_key]
+        logger.warning(f"Forwarded message {forwarded_msg_id} no longer exists in {mapping['destination']}; mapping dropped")
+        message_store.delete(mapping_key)
     except errors.FloodWaitError as e:
-        logger.warning(f"Flood wait error while editing, sleeping for {e.seconds} seconds...")
-        await asyncio.sleep(e.seconds)
+        logger.warning(f"Flood wait error while editing message {forwarded_msg_id}; edit dropped")
+        rate_limiter.record_flood_wait('edit', destination, e.seconds)
     except Exception as e:
         logger.error(f"Error editing forwarded message {forwarded_msg_id}: {e}")
 
-async def delete_forwarded_message(event, mapping, user_id, pair_name):
-    """Delete a forwarded message if the source message is deleted."""
-    try:
-        mapping_key = f"{mapping['source']}:{event.message.id}"
-        if not hasattr(client, 'forwarded_messages'):
-            logger.warning("No forwarded_messages attribute found on client")
-            return
-        if mapping_key not in client.forwarded_messages:
-            logger.warning(f"No mapping found for deleted message: {mapping_key}")
-            return
+async def delete_forwarded_messages(chat_id, deleted_ids):
+    """Delete the forwarded copies of deleted source messages with one call per destination and batch."""
+    targets = {}  # destination -> [(forwarded message ID, mapping key, user_id, pair_name)]
+    for user_id, pair_name, mapping in source_index.get(chat_id, []):
+        source, destination = int(mapping['source']), int(mapping['destination'])
+        found = message_store.get_many(source, deleted_ids, destination)
+        targets.setdefault(destination, []).extend(
+            (forwarded_msg_id, (source, source_msg_id, destination), user_id, pair_name)
+            for source_msg_id, forwarded_msg_id in found.items()
+        )
 
-        forwarded_msg_id = client.forwarded_messages[mapping_key]
-        await client.delete_messages(int(mapping['destination']), [forwarded_msg_id])
-        pair_stats[user_id][pair_name]['deleted'] += 1
-        pair_stats[user_id][pair_name]['last_activity'] = datetime.now().isoformat()
-        logger.info(f"Forwarded message {forwarded_msg_id} deleted from {mapping['destination']}")
-        del client.forwarded_messages[mapping_key]
+    for destination, entries in targets.items():
+        for start in range(0, len(entries), MAX_DELETE_BATCH):
+            batch = entries[start:start + MAX_DELETE_BATCH]
+            forwarded_ids = [entry[0] for entry in batch]
+            deleted = False  # mappings are only dropped once the copies are known to be gone
+            for attempt in range(MAX_RETRIES):
+                try:
+                    await rate_limiter.acquire('delete', destination)
+                    started = time.perf_counter()
+                    await client.delete_messages(input_peer(destination), forwarded_ids)
+                    elapsed = time.perf_counter() - started
+                    for user_id, pair_name in {entry[2:] for entry in batch}:
+                        record_latency(user_id, pair_name, 'delete', elapsed)
+                    rate_limiter.record_success('delete', destination)
+                    logger.info("%d forwarded message(s) deleted from %s", len(forwarded_ids), destination)
+                    deleted = True
+                    break
+                except errors.FloodWaitError as e:
+                    logger.warning(f"Flood wait while deleting {len(forwarded_ids)} message(s) from {destination}; retrying")
+                    rate_limiter.record_flood_wait('delete', destination, e.seconds)
+                except errors.MessageIdInvalidError:
+                    logger.warning(f"Messages {forwarded_ids} in {destination} already deleted or invalid")
+                    deleted = True
+                    break
+                except Exception as e:
+                    logger.error(f"Error deleting forwarded messages {forwarded_ids} from {destination}: {e}")
+                    break
+            else:
+                logger.error(f"Giving up deleting {len(forwarded_ids)} message(s) from {destination} after {MAX_RETRIES} attempts")
+            if not deleted:
+                continue
 
-    except errors.MessageIdInvalidError:
-        logger.warning(f"Cannot delete message {forwarded_msg_id}: Already deleted or invalid")
-        if mapping_key in client.forwarded_messages:
-            del client.forwarded_messages[mapping_key]
-    except Exception as e:
-        logger.error(f"Error deleting forwarded message: {e}")
+            now = datetime.now().isoformat()
+            for _, mapping_key, user_id, pair_name in batch:
+                message_store.delete(mapping_key)
+                if pair_name in pair_stats.get(user_id, {}):
+                    record_stat(user_id, pair_name, 'deleted')
+                    pair_stats[user_id][pair_name]['last_activity'] = now
 
 async def handle_reply_mapping(event, mapping):
-    """Map reply-to messages from source to destination."""
-    if not hasattr(event.message, 'reply_to') or not event.message.reply_to:
+    """Map reply-to messages from source to destination without blocking on extra RPCs."""
+    source_reply_id = event.reply_to
+    if not source_reply_id:
         return None
     try:
-        source_reply_id = event.message.reply_to.reply_to_msg_id
-        if not source_reply_id:
-            return None
-        mapping_key = f"{mapping['source']}:{source_reply_id}"
-        if hasattr(client, 'forwarded_messages') and mapping_key in client.forwarded_messages:
-            return client.forwarded_messages[mapping_key]
-        replied_msg = await client.get_messages(int(mapping['source']), ids=source_reply_id)
-        if replied_msg and replied_msg.text:
-            dest_msgs = await client.get_messages(int(mapping['destination']), search=replied_msg.text[:20], limit=5)
-            if dest_msgs:
-                return dest_msgs[0].id
+        mapping_key = message_key(mapping, source_reply_id)
+        forwarded_reply_id = message_store.get(mapping_key)
+        if forwarded_reply_id is not None:
+            return forwarded_reply_id
+        forwarded_reply_id = reply_targets.get(mapping_key)
+        if forwarded_reply_id is not None:
+            return forwarded_reply_id or None
+        if REPLY_SEARCH_FALLBACK and mapping_key not in reply_searches:
+            task = reply_searches[mapping_key] = asyncio.create_task(search_reply_target(mapping, mapping_key))
+            task.add_done_callback(lambda _: reply_searches.pop(mapping_key, None))
+        else:
+            reply_targets.put(mapping_key, 0)
     except Exception as e:
         logger.error(f"Error handling reply mapping: {e}")
     return None
 
-async def store_message_mapping(event, mapping, sent_message):
+async def search_reply_target(mapping, mapping_key):
+    """Find a reply target missing from the ID map by searching the destination for its text.
+
+    Runs in the background; the result serves later replies to the same message.
+    """
+    forwarded_reply_id = 0
+    try:
+        await rate_limiter.acquire('get_messages')
+        replied_msg = await client.get_messages(input_peer(mapping['source']), ids=mapping_key[1])
+        if replied_msg and replied_msg.text:
+            await rate_limiter.acquire('search')
+            dest_msgs = await client.get_messages(input_peer(mapping['destination']), search=replied_msg.text[:20], limit=5)
+            rate_limiter.record_success('search')
+            if dest_msgs:
+                forwarded_reply_id = dest_msgs[0].id
+    except errors.FloodWaitError as e:
+        rate_limiter.record_flood_wait('search', None, e.seconds)
+    except Exception as e:
+        logger.error(f"Error searching reply target {mapping_key}: {e}")
+    reply_targets.put(mapping_key, forwarded_reply_id)
+
+async def store_message_mapping(event, mapping, sent_message, user_id, pair_name, content_hash=None):
     """Store mapping of source to forwarded message IDs."""
     try:
-        if not hasattr(event.message, 'id'):
-            return
-        if not hasattr(client, 'forwarded_messages'):
-            client.forwarded_messages = {}
-        if len(client.forwarded_messages) >= MAX_MAPPING_HISTORY:
-            oldest_key = next(iter(client.forwarded_messages))
-            client.forwarded_messages.pop(oldest_key)
-        source_msg_id = event.message.id
-        mapping_key = f"{mapping['source']}:{source_msg_id}"
-        client.forwarded_messages[mapping_key] = sent_message.id
+        message_store.put(
+            message_key(mapping, event.id), sent_message.id, f"{user_id}:{pair_name}", content_hash
+        )
     except Exception as e:
         logger.error(f"Error storing message mapping: {e}")
 
@@ -620,11 +2346,43 @@ async def send_split_message_event(event, full_message):
         await event.reply(f"📜 Part {i}/{len(parts)}\n{part}")
         await asyncio.sleep(0.5)
 
-@client.on(events.NewMessage(pattern='(?i)^/start$'))
+def command(name, args_pattern='$'):
+    """Register a handler for /name; dispatch_command sets event.pattern_match to the argument match."""
+    pattern = re.compile(args_pattern)
+
+    def register(handler):
+        command_handlers[name] = (pattern, handler)
+        return handler
+    return register
+
+def is_command_message(event):
+    """Cheap event-level check: a slash message sent by the account owner."""
+    return event.raw_text.startswith('/') and (event.out or (OWNER_ID is not None and event.sender_id == OWNER_ID))
+
+@client.on(events.NewMessage(func=is_command_message))
+async def dispatch_command(event):
+    """Route a command to its handler by its first token instead of running every handler's regex."""
+    name, _, args = event.raw_text.partition(' ')
+    name, _, _ = name.partition('\n')
+    entry = command_handlers.get(name.lower())
+    if entry is None:
+        return
+    pattern, handler = entry
+    match = pattern.match(args.lstrip(' '))
+    if match is None:
+        await event.reply(f"❌ Invalid arguments for {name}. Use `/commands` for usage.")
+        return
+    event.pattern_match = match
+    try:
+        await handler(event)
+    except Exception as e:
+        logger.error(f"Error handling {name}: {e}", exc_info=True)
+
+@command('/start')
 async def start(event):
     await event.reply("✅ ForwardBot Running!\nUse `/commands` for options.")
 
-@client.on(events.NewMessage(pattern='(?i)^/commands$'))
+@command('/commands')
 async def list_commands(event):
     commands = """
     📋 ForwardBot Commands
@@ -636,8 +2394,12 @@ async def list_commands(event):
     - `/startpair <name>` - Resume a pair
     - `/clearpairs` - Remove all pairs
     - `/togglementions <name>` - Toggle mention removal
+    - `/setretention <name> <days> [count]` - Set how long message ID mappings are kept
     - `/monitor` - View pair stats
+    - `/perf [name]` - View per-stage latency percentiles
+    - `/clonehistory <name> [from_id] [to_id]` - Copy a pair's existing source history to its destination
     - `/status` - Check bot status
+    - `/retryfailed` - Requeue messages that failed to send
 
     **🔍 Filters**
     - `/addblacklist <name> <word1,word2,...>` - Blacklist words
@@ -651,7 +2413,7 @@ async def list_commands(event):
     - `/clearheaderfooter <name>` - Clear header/footer
 
     **🖼️ Image Blocking**
-    - `/blockimage <name>` - Block a specific image (reply to image)
+    - `/blockimage <name> [threshold]` - Block a specific image (reply to image); threshold sets the match distance (0-64)
     - `/clearblockedimages <name>` - Clear blocked images
     - `/showblockedimages <name>` - Show blocked image hashes
 
@@ -667,15 +2429,61 @@ async def list_commands(event):
     """
     await event.reply(commands)
 
-@client.on(events.NewMessage(pattern='(?i)^/status$'))
+@command('/status')
 async def status(event):
     status_msg = f"🛠️ Bot Status\n" \
                  f"📡 Connected: {'✅' if is_connected else '❌'}\n" \
-                 f"📥 Queue Size: {len(message_queue)}/{MAX_QUEUE_SIZE}\n" \
+                 f"📥 Queue Size: {queue_depth()} across {len(send_lanes)} lane(s)\n" \
+                 f"⚠️ Failed: {durable_queue.count_failed()}\n" \
                  f"📊 Total Pairs: {sum(len(pairs) for pairs in channel_mappings.values())}"
+    for source_id, (scanned, total) in catch_up_progress.items():
+        status_msg += f"\n🔄 Catching up {source_id}: {scanned}/{total} message IDs scanned"
+    for _, user_id, pair_name, last_msg_id, end_msg_id in clone_tasks.values():
+        if user_id == str(event.sender_id):
+            status_msg += f"\n📚 Cloning '{pair_name}': up to message {last_msg_id} of {end_msg_id}"
     await event.reply(status_msg)
 
-@client.on(events.NewMessage(pattern='(?i)^/monitor$'))
+@command('/retryfailed')
+async def retry_failed(event):
+    destinations = durable_queue.retry_failed()
+    if not destinations:
+        await event.reply("📭 No failed messages to retry.")
+        return
+    for destination in destinations:
+        lane = get_lane(destination)
+        lane.spilled = True
+        lane.wakeup.set()
+    await event.reply(f"🔁 Failed messages requeued for {len(destinations)} destination(s).")
+
+@command('/perf', r'(\S+)?$')
+async def perf_report(event):
+    user_id = str(event.sender_id)
+    pair_name = event.pattern_match.group(1)
+    if user_id not in channel_mappings or not channel_mappings[user_id]:
+        await event.reply("❌ No forwarding pairs found.")
+        return
+    if pair_name and pair_name not in channel_mappings[user_id]:
+        await event.reply("❌ Pair not found.")
+        return
+
+    stages = {}
+    for (owner, name, stage), histogram in latency_histograms.items():
+        if owner == user_id and (pair_name is None or name == pair_name):
+            stages.setdefault(stage, LatencyHistogram()).merge(histogram)
+    if not stages:
+        await event.reply("📭 No latency samples yet.")
+        return
+
+    lines = [f"⏱️ Stage Latency ({pair_name or 'all pairs'})", "--------------------"]
+    for stage in LATENCY_STAGES:
+        histogram = stages.get(stage)
+        if histogram is None:
+            continue
+        p50, p95, p99 = (histogram.percentile(percent) * 1000 for percent in (50, 95, 99))
+        lines.append(f"{stage}: p50 {p50:.1f}ms | p95 {p95:.1f}ms | p99 {p99:.1f}ms (n={histogram.total})")
+    await send_split_message_event(event, "\n".join(lines))
+
+@command('/monitor')
 async def monitor_pairs(event):
     user_id = str(event.sender_id)
     if user_id not in channel_mappings or not channel_mappings[user_id]:
@@ -683,12 +2491,13 @@ async def monitor_pairs(event):
         return
 
     header = "📊 Forwarding Monitor\n--------------------\n"
-    footer = f"\n--------------------\n📥 Total Queued: {len(message_queue)}"
+    footer = f"\n--------------------\n📥 Total Queued: {queue_depth()}"
     report = []
     for pair_name, data in channel_mappings[user_id].items():
-        stats = pair_stats.get(user_id, {}).get(pair_name, {
-            'forwarded': 0, 'edited': 0, 'deleted': 0, 'blocked': 0, 'queued': 0, 'last_activity': None
-        })
+        stats = pair_stats.get(user_id, {}).get(pair_name) or empty_pair_stats()
+        last_minute = metrics.window(user_id, pair_name, 60, 1)
+        last_hour = metrics.window(user_id, pair_name, 60, 60)
+        last_day = metrics.window(user_id, pair_name, 3600, 24)
         last_activity = stats['last_activity'] or 'N/A'
         if len(last_activity) > 20:
             last_activity = last_activity[:17] + "..."
@@ -697,13 +2506,16 @@ async def monitor_pairs(event):
             f"   ➡️ Route: {data['source']} → {data['destination']}\n"
             f"   ✅ Status: {'Active' if data['active'] else 'Paused'}\n"
             f"   📈 Stats: Fwd: {stats['forwarded']} | Edt: {stats['edited']} | Del: {stats['deleted']} | Blk: {stats['blocked']} | Que: {stats['queued']}\n"
+            f"   ⏱️ Last min: {last_minute['forwarded']} fwd, {format_error_rate(last_minute)} err\n"
+            f"   🕐 Last hour: {last_hour['forwarded'] / 60:.1f} fwd/min, {format_error_rate(last_hour)} err\n"
+            f"   📅 Last 24h: {last_day['forwarded'] / 24:.1f} fwd/hour, {format_error_rate(last_day)} err\n"
             f"   ⏰ Last: {last_activity}\n"
             f"---------------"
         )
     full_message = header + "\n".join(report) + footer
     await send_split_message_event(event, full_message)
 
-@client.on(events.NewMessage(pattern=r'/setpair (\S+) (\S+) (\S+)(?: (yes|no))?'))
+@command('/setpair', r'(\S+) (\S+) (\S+)(?: (yes|no))?')
 async def set_pair(event):
     pair_name, source, destination, remove_mentions = event.pattern_match.groups()
     user_id = str(event.sender_id)
@@ -732,20 +2544,40 @@ async def set_pair(event):
         'blocked_sentences': [],
         'blocked_image_hashes': []
     }
-    pair_stats[user_id][pair_name] = {'forwarded': 0, 'edited': 0, 'deleted': 0, 'blocked': 0, 'queued': 0, 'last_activity': None}
+    pair_stats[user_id][pair_name] = empty_pair_stats()
+    reset_latency(user_id, pair_name)
+    if metrics is not None:
+        metrics.reset(user_id, pair_name)
+    durable_queue.forget_progress(user_id, pair_name)
+    index_pair(user_id, pair_name)
+    refresh_peer(source)
+    refresh_peer(destination)
+    invalidate_filters(user_id, pair_name)
     save_mappings()
     logger.info(f"Pair {pair_name} successfully set for user {user_id}")
     await event.reply(f"✅ Pair '{pair_name}' Added\n{source} ➡️ {destination}\nMentions: {'✅' if remove_mentions else '❌'}")
 
-@client.on(events.NewMessage(pattern=r'/blockimage (\S+)'))
+@command('/blockimage', r'(\S+)(?: (\d+))?')
 async def block_image(event):
-    pair_name = event.pattern_match.group(1)
+    pair_name, threshold = event.pattern_match.group(1), event.pattern_match.group(2)
     user_id = str(event.sender_id)
 
     if user_id not in channel_mappings or pair_name not in channel_mappings[user_id]:
         await event.reply("❌ Pair not found. Use /listpairs or /setpair.")
         return
 
+    if threshold is not None:
+        threshold = int(threshold)
+        if threshold > 64:
+            await event.reply("❌ Threshold must be between 0 and 64.")
+            return
+        channel_mappings[user_id][pair_name]['image_hash_threshold'] = threshold
+        invalidate_filters(user_id, pair_name)
+        save_mappings()
+        if not event.message.reply_to:
+            await event.reply(f"🖼️ Image match threshold for '{pair_name}' set to {threshold} bit(s)")
+            return
+
     if not event.message.reply_to:
         await event.reply("📷 Please reply to an image to block it.")
         return
@@ -756,12 +2588,14 @@ async def block_image(event):
         return
 
     try:
-        photo = await client.download_media(replied_msg, bytes)
-        image = Image.open(io.BytesIO(photo))
-        image_hash = str(imagehash.phash(image))
+        image_hash = await get_photo_hash(replied_msg)
+        if image_hash is None:
+            await event.reply("❌ Error blocking image: could not hash the image, try again later")
+            return
 
         channel_mappings[user_id][pair_name].setdefault('blocked_image_hashes', []).append(image_hash)
         channel_mappings[user_id][pair_name]['blocked_image_hashes'] = list(set(channel_mappings[user_id][pair_name]['blocked_image_hashes']))
+        invalidate_filters(user_id, pair_name)
         save_mappings()
 
         logger.info(f"Blocked image hash {image_hash} for pair {pair_name} by user {user_id}")
@@ -770,56 +2604,60 @@ async def block_image(event):
         logger.error(f"Error blocking image: {e}", exc_info=True)
         await event.reply(f"❌ Error blocking image: {str(e)}")
 
-@client.on(events.NewMessage(pattern='(?i)^/clearblockedimages (\S+)$'))
+@command('/clearblockedimages', r'(\S+)$')
 async def clear_blocked_images(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
 
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name]['blocked_image_hashes'] = []
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"🖼️ Blocked images cleared for '{pair_name}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/showblockedimages (\S+)$'))
+@command('/showblockedimages', r'(\S+)$')
 async def show_blocked_images(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
 
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         blocked_hashes = channel_mappings[user_id][pair_name].get('blocked_image_hashes', [])
+        threshold = channel_mappings[user_id][pair_name].get('image_hash_threshold', IMAGE_HASH_THRESHOLD)
         if blocked_hashes:
             hashes_list = "\n".join([f"• {h}" for h in blocked_hashes])
-            await event.reply(f"🖼️ Blocked Image Hashes for '{pair_name}'\n{hashes_list}")
+            await event.reply(f"🖼️ Blocked Image Hashes for '{pair_name}' (threshold: {threshold} bits)\n{hashes_list}")
         else:
             await event.reply(f"ℹ️ No blocked images for '{pair_name}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern=r'/blocksentence (\S+) (.+)'))
+@command('/blocksentence', r'(\S+) (.+)')
 async def block_sentence(event):
     pair_name, sentence = event.pattern_match.group(1), event.pattern_match.group(2)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name].setdefault('blocked_sentences', []).append(sentence)
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"🚫 Blocked sentence added for '{pair_name}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/clearblocksentences (\S+)$'))
+@command('/clearblocksentences', r'(\S+)$')
 async def clear_block_sentences(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name]['blocked_sentences'] = []
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"🚫 Blocked sentences cleared for '{pair_name}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/showblocksentences (\S+)$'))
+@command('/showblocksentences', r'(\S+)$')
 async def show_block_sentences(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
@@ -833,30 +2671,32 @@ async def show_block_sentences(event):
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern=r'/addblacklist (\S+) (.+)'))
+@command('/addblacklist', r'(\S+) (.+)')
 async def add_blacklist(event):
     pair_name, words = event.pattern_match.group(1), event.pattern_match.group(2).split(',')
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name].setdefault('blacklist', []).extend([w.strip() for w in words])
         channel_mappings[user_id][pair_name]['blacklist'] = list(set(channel_mappings[user_id][pair_name]['blacklist']))
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"🔍 Added {len(words)} word(s) to blacklist for '{pair_name}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/clearblacklist (\S+)$'))
+@command('/clearblacklist', r'(\S+)$')
 async def clear_blacklist(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name]['blacklist'] = []
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"🔍 Blacklist cleared for '{pair_name}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/showblacklist (\S+)$'))
+@command('/showblacklist', r'(\S+)$')
 async def show_blacklist(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
@@ -870,124 +2710,178 @@ async def show_blacklist(event):
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/toggleurlblock (\S+)$'))
+@command('/toggleurlblock', r'(\S+)$')
 async def toggle_url_block(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         current_status = channel_mappings[user_id][pair_name].get('block_urls', False)
         channel_mappings[user_id][pair_name]['block_urls'] = not current_status
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         status = "ENABLED" if not current_status else "DISABLED"
         await event.reply(f"🔗 URL Blocking {status} for '{pair_name}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern=r'/addurlblacklist (\S+) (.+)'))
+@command('/addurlblacklist', r'(\S+) (.+)')
 async def add_url_blacklist(event):
     pair_name, urls = event.pattern_match.group(1), event.pattern_match.group(2).split(',')
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name].setdefault('blacklist_urls', []).extend([u.strip() for u in urls])
         channel_mappings[user_id][pair_name]['blacklist_urls'] = list(set(channel_mappings[user_id][pair_name]['blacklist_urls']))
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"🔗 Added {len(urls)} URL(s) to blacklist for '{pair_name}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/clearurlblacklist (\S+)$'))
+@command('/clearurlblacklist', r'(\S+)$')
 async def clear_url_blacklist(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name]['blacklist_urls'] = []
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"🔗 URL blacklist cleared for '{pair_name}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern=r'/setheader (\S+) (.+)'))
+@command('/setheader', r'(\S+) (.+)')
 async def set_header(event):
     pair_name, pattern = event.pattern_match.group(1), event.pattern_match.group(2)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name]['header_pattern'] = pattern
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"📑 Header set for '{pair_name}': '{pattern}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern=r'/setfooter (\S+) (.+)'))
+@command('/setfooter', r'(\S+) (.+)')
 async def set_footer(event):
     pair_name, pattern = event.pattern_match.group(1), event.pattern_match.group(2)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name]['footer_pattern'] = pattern
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"📑 Footer set for '{pair_name}': '{pattern}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/clearheaderfooter (\S+)$'))
+@command('/clearheaderfooter', r'(\S+)$')
 async def clear_header_footer(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name]['header_pattern'] = ''
         channel_mappings[user_id][pair_name]['footer_pattern'] = ''
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"📑 Header/Footer cleared for '{pair_name}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern=r'/setcustomheader (\S+) (.+)'))
+@command('/setcustomheader', r'(\S+) (.+)')
 async def set_custom_header(event):
     pair_name, text = event.pattern_match.group(1), event.pattern_match.group(2)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name]['custom_header'] = text
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"✍️ Custom header set for '{pair_name}': '{text}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern=r'/setcustomfooter (\S+) (.+)'))
+@command('/setcustomfooter', r'(\S+) (.+)')
 async def set_custom_footer(event):
     pair_name, text = event.pattern_match.group(1), event.pattern_match.group(2)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name]['custom_footer'] = text
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"✍️ Custom footer set for '{pair_name}': '{text}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/clearcustomheaderfooter (\S+)$'))
+@command('/clearcustomheaderfooter', r'(\S+)$')
 async def clear_custom_header_footer(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name]['custom_header'] = ''
         channel_mappings[user_id][pair_name]['custom_footer'] = ''
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         await event.reply(f"✍️ Custom header/footer cleared for '{pair_name}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/togglementions (\S+)$'))
+@command('/togglementions', r'(\S+)$')
 async def toggle_mentions(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         current_status = channel_mappings[user_id][pair_name]['remove_mentions']
         channel_mappings[user_id][pair_name]['remove_mentions'] = not current_status
+        invalidate_filters(user_id, pair_name)
         save_mappings()
         status = "ENABLED" if not current_status else "DISABLED"
         await event.reply(f"👤 Mention removal {status} for '{pair_name}'")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/listpairs$'))
+@command('/setretention', r'(\S+) (\d+)(?: (\d+))?$')
+async def set_retention(event):
+    pair_name, days, count = event.pattern_match.groups()
+    user_id = str(event.sender_id)
+    if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
+        channel_mappings[user_id][pair_name]['mapping_retention_days'] = int(days)
+        if count:
+            channel_mappings[user_id][pair_name]['mapping_retention_count'] = int(count)
+        save_mappings()
+        count = channel_mappings[user_id][pair_name].get('mapping_retention_count', MAPPING_RETENTION_COUNT)
+        await event.reply(f"🗄️ Message mappings for '{pair_name}' kept for {days} day(s), up to {count} messages")
+    else:
+        await event.reply("❌ Pair not found.")
+
+@command('/clonehistory', r'(\S+)(?: (\d+))?(?: (\d+))?$')
+async def clone_history_command(event):
+    pair_name, first_msg_id, end_msg_id = event.pattern_match.groups()
+    user_id = str(event.sender_id)
+    if user_id not in channel_mappings or pair_name not in channel_mappings[user_id]:
+        await event.reply("❌ Pair not found.")
+        return
+    source = int(channel_mappings[user_id][pair_name]['source'])
+    for job in durable_queue.clone_jobs():
+        if job[1] == user_id and job[2] == pair_name:
+            if job[0] in clone_tasks:
+                await event.reply(f"📚 '{pair_name}' is already being cloned. See `/status` for progress.")
+            else:
+                start_clone_task(job)
+                await event.reply(f"▶️ Resuming clone of '{pair_name}' after message {job[6]}.")
+            return
+
+    if end_msg_id is None:
+        # Fixed up front, so messages arriving during the clone are left to the live handler
+        await rate_limiter.acquire('get_messages')
+        latest = await client.get_messages(input_peer(source), limit=1)
+        end_msg_id = latest[0].id if latest else 0
+    first_msg_id, end_msg_id = int(first_msg_id or 1), int(end_msg_id)
+    if end_msg_id < first_msg_id:
+        await event.reply("❌ Nothing to clone in that range.")
+        return
+    job_id = durable_queue.start_clone(user_id, pair_name, source, first_msg_id, end_msg_id)
+    start_clone_task((job_id, user_id, pair_name, source, first_msg_id, end_msg_id, first_msg_id - 1))
+    await event.reply(f"📚 Cloning '{pair_name}': messages {first_msg_id}..{end_msg_id}. See `/status` for progress.")
+
+@command('/listpairs')
 async def list_pairs(event):
     user_id = str(event.sender_id)
     if user_id not in channel_mappings or not channel_mappings[user_id]:
@@ -1014,125 +2908,519 @@ async def list_pairs(event):
     full_message = header + "\n".join(pairs_list)
     await send_split_message_event(event, full_message)
 
-@client.on(events.NewMessage(pattern='(?i)^/pausepair (\S+)$'))
+@command('/pausepair', r'(\S+)$')
 async def pause_pair(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name]['active'] = False
+        unindex_pair(user_id, pair_name)
+        durable_queue.forget_progress(user_id, pair_name)
         save_mappings()
         await event.reply(f"⏸️ Pair '{pair_name}' paused.")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/startpair (\S+)$'))
+@command('/startpair', r'(\S+)$')
 async def start_pair(event):
     pair_name = event.pattern_match.group(1)
     user_id = str(event.sender_id)
     if user_id in channel_mappings and pair_name in channel_mappings[user_id]:
         channel_mappings[user_id][pair_name]['active'] = True
+        index_pair(user_id, pair_name)
         save_mappings()
         await event.reply(f"▶️ Pair '{pair_name}' activated.")
     else:
         await event.reply("❌ Pair not found.")
 
-@client.on(events.NewMessage(pattern='(?i)^/clearpairs$'))
+@command('/clearpairs')
 async def clear_pairs(event):
     user_id = str(event.sender_id)
     if user_id in channel_mappings:
+        for pair_name in channel_mappings[user_id]:
+            reset_latency(user_id, pair_name)
+            durable_queue.forget_progress(user_id, pair_name)
+            if metrics is not None:
+                metrics.reset(user_id, pair_name)
         channel_mappings[user_id] = {}
         pair_stats[user_id] = {}
+        unindex_user(user_id)
+        invalidate_filters(user_id)
         save_mappings()
         await event.reply("🗑️ All pairs cleared.")
     else:
         await event.reply("❌ No pairs to clear.")
 
-@client.on(events.NewMessage)
+def is_source_event(event):
+    """Event-level filter so only traffic from indexed source chats reaches the forwarding handlers."""
+    return event.chat_id in source_index
+
+@client.on(events.NewMessage(func=is_source_event))
 async def forward_messages(event):
     """Queue incoming messages for forwarding with timestamp."""
+    # A message outside an open album means that album is complete, and it must not overtake it
+    flush_albums_of(event.chat_id, event.message.grouped_id)
+    if event.message.grouped_id:
+        buffer_album_item(event)
+        return
+    queue_for_pairs(SourceMessage.from_message(event.message, event.chat_id), event.chat_id)
+
+def queue_for_pairs(event, source_id):
+    """Fan a source message, or an album as a list of them, out to every active pair of its source chat.
+
+    All pairs share the same SourceMessage, and each destination lane sends concurrently. While the
+    source is being caught up, its messages are held so they go out after the backlog.
+    """
+    if source_id in catch_up_held:
+        catch_up_held[source_id].append(event)
+        return
     queued_time = datetime.now()
-    for user_id, pairs in channel_mappings.items():
-        for pair_name, mapping in pairs.items():
-            if mapping['active'] and event.chat_id == int(mapping['source']):
-                message_queue.append((event, mapping, user_id, pair_name, queued_time))
-                pair_stats[user_id][pair_name]['queued'] += 1
-                logger.info(f"Message queued for '{pair_name}' at {queued_time.isoformat()}")
-                return
+    for user_id, pair_name, mapping in source_index.get(source_id, []):
+        if enqueue_message(event, mapping, user_id, pair_name, queued_time):
+            record_stat(user_id, pair_name, 'queued')
+            logger.info("Message queued for '%s' at %s", pair_name, queued_time, extra=sampled(pair_name))
+
+def buffer_album_item(event):
+    """Hold album items until the album is complete or ALBUM_WINDOW passes without a new item."""
+    key = (event.chat_id, event.message.grouped_id)
+    deadline = asyncio.get_running_loop().time() + ALBUM_WINDOW
+    buffer = album_buffers.get(key)
+    if buffer is None:
+        buffer = album_buffers[key] = [[], deadline]
+        asyncio.create_task(flush_album(key))
+    buffer[0].append(SourceMessage.from_message(event.message, event.chat_id))
+    buffer[1] = deadline if len(buffer[0]) < MAX_ALBUM_SIZE else 0
+
+def schedule_catch_up():
+    """Start catching up from the progress saved at the last disconnect, unless a catch-up is running.
+
+    Live messages can arrive before this runs and move the stored progress past the missed range,
+    which is why the starting point is captured when the connection drops instead of read here.
+    A reconnect during a running catch-up leaves its starting point pending until that one finishes.
+    """
+    global catch_up_task, catch_up_from
+    if catch_up_from is None or (catch_up_task is not None and not catch_up_task.done()):
+        return
+    catch_up_task = asyncio.create_task(catch_up(catch_up_from))
+    catch_up_task.add_done_callback(lambda _: schedule_catch_up() if is_connected else None)
+    catch_up_from = None
+
+async def catch_up(progress):
+    """Queue source messages published while the bot was offline, for every pair with a catch-up point."""
+    by_source = {}  # source chat ID -> [(user_id, pair_name, mapping, last queued message ID)]
+    for source_id, entries in source_index.items():
+        for user_id, pair_name, mapping in entries:
+            source_chat, last_msg_id = progress.get((user_id, pair_name), (None, None))
+            if source_chat == source_id:
+                by_source.setdefault(source_id, []).append((user_id, pair_name, mapping, last_msg_id))
+    if not by_source:
+        return
+    for source_id in by_source:
+        catch_up_held.setdefault(source_id, [])
+    results = await asyncio.gather(
+        *(catch_up_source(source_id, pairs) for source_id, pairs in by_source.items()), return_exceptions=True
+    )
+    queued = 0
+    for source_id, result in zip(by_source, results):
+        if isinstance(result, Exception):
+            logger.error(f"Catch-up failed for source {source_id}: {result}")
+        else:
+            queued += result
+    if queued:
+        logger.info(f"🔄 Catch-up queued {queued} missed message(s) from {len(by_source)} source(s)")
+        if NOTIFY_CHAT_ID:
+            await client.send_message(NOTIFY_CHAT_ID, f"🔄 Catch-up queued {queued} missed message(s) from {len(by_source)} source(s)")
+
+async def catch_up_source(source_id, pairs):
+    """Fetch one source chat's missed messages in ID batches and queue them, in order, for its pairs.
+
+    Returns the number of (message, pair) items queued. Live messages held for the source meanwhile
+    are queued afterwards; those catch-up already queued are dropped as duplicates.
+    """
+    queued = 0
+    album = []
+
+    def queue_missed(item):
+        nonlocal queued
+        first_id = item[0].id if isinstance(item, list) else item.id
+        queued_time = datetime.now()
+        for user_id, pair_name, mapping, last_msg_id in pairs:
+            if first_id > last_msg_id and enqueue_message(item, mapping, user_id, pair_name, queued_time):
+                record_stat(user_id, pair_name, 'queued')
+                queued += 1
 
-@client.on(events.MessageEdited)
+    try:
+        start = min(last_msg_id for _, _, _, last_msg_id in pairs) + 1
+        await rate_limiter.acquire('get_messages')
+        latest = await client.get_messages(input_peer(source_id), limit=1)
+        end = latest[0].id if latest else 0
+        if end < start:
+            return 0
+        logger.info(f"Catching up on source {source_id}: message IDs {start}..{end}")
+        catch_up_progress[source_id] = [0, end - start + 1]
+        for batch_start in range(start, end + 1, CATCHUP_BATCH):
+            message_ids = list(range(batch_start, min(batch_start + CATCHUP_BATCH, end + 1)))
+            for attempt in range(MAX_RETRIES):
+                await rate_limiter.acquire('get_messages')
+                try:
+                    messages = await client.get_messages(input_peer(source_id), ids=message_ids)
+                    break
+                except errors.FloodWaitError as e:
+                    # The rate limiter holds the next attempt back for the wait
+                    rate_limiter.record_flood_wait('get_messages', None, e.seconds)
+            else:
+                raise RuntimeError(f"gave up on message IDs {message_ids[0]}..{message_ids[-1]} after repeated flood waits")
+            for message in messages:
+                # Deleted IDs come back as None; service messages are not forwarded live either
+                if message is None or getattr(message, 'action', None):
+                    continue
+                record = SourceMessage.from_message(message, source_id)
+                if album and record.grouped_id != album[0].grouped_id:
+                    queue_missed(album if len(album) > 1 else album[0])
+                    album = []
+                if record.grouped_id:
+                    album.append(record)
+                else:
+                    queue_missed(record)
+            catch_up_progress[source_id][0] += len(message_ids)
+        if album:
+            queue_missed(album if len(album) > 1 else album[0])
+    finally:
+        catch_up_progress.pop(source_id, None)
+        for event in catch_up_held.pop(source_id, []):
+            queue_for_pairs(event, source_id)
+    logger.info(f"Catch-up of source {source_id} done: {queued} item(s) queued")
+    return queued
+
+def start_clone_task(job):
+    """Run a clone job in the background, tracked in clone_tasks until it ends."""
+    job_id, user_id, pair_name, _, _, end_msg_id, last_msg_id = job
+    entry = clone_tasks[job_id] = [None, user_id, pair_name, last_msg_id, end_msg_id]
+    entry[0] = asyncio.create_task(clone_history(job))
+    entry[0].add_done_callback(lambda _: clone_tasks.pop(job_id, None))
+
+def resume_clone_jobs():
+    """Restart clone jobs interrupted by a crash or shutdown from their checkpoints."""
+    for job in durable_queue.clone_jobs():
+        if job[0] not in clone_tasks:
+            start_clone_task(job)
+
+async def clone_history(job):
+    """Queue a pair's source history, oldest first, to its destination lane.
+
+    History is queued like live messages, so the pair's filters apply, passthrough pairs go out in
+    server-side forward batches and albums stay grouped. Each queued item moves the job's checkpoint
+    on disk. The next page is only read once the lane has room for it, so history streams through
+    memory instead of piling up in the state database.
+    """
+    job_id, user_id, pair_name, source_chat, first_msg_id, end_msg_id, last_msg_id = job
+    entry = clone_tasks[job_id]
+    cursor = last_msg_id  # last message ID read, which runs ahead of the checkpoint while an album is open
+    queued = 0
+    album = []
+
+    def queue_history(item, mapping):
+        nonlocal queued
+        if enqueue_message(item, mapping, user_id, pair_name, datetime.now(), job_id):
+            record_stat(user_id, pair_name, 'queued')
+            queued += 1
+        entry[3] = item[-1].id if isinstance(item, list) else item.id
+
+    logger.info(f"Cloning '{pair_name}' from source {source_chat}: message IDs {last_msg_id + 1}..{end_msg_id}")
+    while cursor < end_msg_id:
+        mapping = channel_mappings.get(user_id, {}).get(pair_name)
+        if mapping is None or int(mapping['source']) != source_chat:
+            logger.warning(f"Clone of '{pair_name}' dropped: the pair was removed or its source changed")
+            durable_queue.finish_clone(job_id)
+            return
+        lane = get_lane(int(mapping['destination']))
+        # Pausing a pair pauses its clone too, like it stops the pair's live forwarding
+        if not is_connected or not mapping['active'] or lane.spilled or len(lane.items) > max(MAX_QUEUE_SIZE - CLONE_PAGE_SIZE, 0):
+            await asyncio.sleep(1)
+            continue
+
+        await rate_limiter.acquire('get_messages')
+        try:
+            messages = [
+                message async for message in client.iter_messages(
+                    input_peer(source_chat), limit=CLONE_PAGE_SIZE, min_id=cursor, max_id=end_msg_id + 1, reverse=True
+                )
+            ]
+        except errors.FloodWaitError as e:
+            # The rate limiter holds the next page back for the wait
+            rate_limiter.record_flood_wait('get_messages', None, e.seconds)
+            continue
+        except ConnectionError:
+            continue
+        except errors.RPCError as e:
+            if isinstance(e, PEER_ERRORS):
+                refresh_peer(source_chat)
+            logger.error(f"Clone of '{pair_name}' stopped at message {entry[3]}: {e}")
+            if NOTIFY_CHAT_ID:
+                await client.send_message(NOTIFY_CHAT_ID, f"⚠️ Clone of '{pair_name}' stopped at message {entry[3]}: {e}\nUse `/clonehistory {pair_name}` to resume.")
+            return
+        if not messages:
+            break
+
+        for message in messages:
+            # Service messages are not forwarded live either
+            if getattr(message, 'action', None):
+                continue
+            record = SourceMessage.from_message(message, source_chat)
+            if album and (record.grouped_id != album[0].grouped_id or len(album) == MAX_ALBUM_SIZE):
+                queue_history(album if len(album) > 1 else album[0], mapping)
+                album = []
+            if record.grouped_id:
+                album.append(record)
+            else:
+                queue_history(record, mapping)
+        cursor = messages[-1].id
+        logger.debug(f"Clone of '{pair_name}' read up to message {cursor} of {end_msg_id}")
+
+    if album:
+        queue_history(album if len(album) > 1 else album[0], mapping)
+    durable_queue.finish_clone(job_id)
+    logger.info(f"📚 Clone of '{pair_name}' done: {queued} item(s) queued")
+    if NOTIFY_CHAT_ID:
+        await client.send_message(NOTIFY_CHAT_ID, f"📚 Clone of '{pair_name}' done: {queued} item(s) queued")
+
+async def sleep_until_deadline(buffers, key):
+    """Sleep until buffers[key]'s deadline, following it as new items push it back, or until the key is gone."""
+    loop = asyncio.get_running_loop()
+    while key in buffers:
+        delay = buffers[key][1] - loop.time()
+        if delay <= 0:
+            return
+        await asyncio.sleep(delay)
+
+async def flush_album(key):
+    """Queue a buffered album once its window has closed, unless a later message already flushed it."""
+    await sleep_until_deadline(album_buffers, key)
+    buffer = album_buffers.pop(key, None)
+    if buffer is not None:
+        queue_album(key[0], buffer[0])
+
+def flush_albums_of(chat_id, grouped_id=None):
+    """Queue a chat's buffered albums other than grouped_id right away, oldest first."""
+    keys = [key for key in album_buffers if key[0] == chat_id and key[1] != grouped_id]
+    albums = [album_buffers.pop(key)[0] for key in keys]
+    for album_events in sorted(albums, key=lambda album_events: min(album_event.id for album_event in album_events)):
+        queue_album(chat_id, album_events)
+
+def queue_album(chat_id, album_events):
+    album_events.sort(key=lambda album_event: album_event.id)
+    queue_for_pairs(album_events if len(album_events) > 1 else album_events[0], chat_id)
+
+@client.on(events.MessageEdited(func=is_source_event))
 async def handle_message_edit(event):
-    """Handle edits to source messages."""
+    """Handle edits to source messages, coalescing bursts into one edit per destination."""
     if not is_connected:
         return
-    for user_id, pairs in channel_mappings.items():
-        for pair_name, mapping in pairs.items():
-            if mapping['active'] and event.chat_id == int(mapping['source']):
-                try:
-                    await edit_forwarded_message(event, mapping, user_id, pair_name)
-                except Exception as e:
-                    logger.error(f"Error editing for '{pair_name}': {e}")
-                return
+    key = (event.chat_id, event.message.id)
+    deadline = asyncio.get_running_loop().time() + EDIT_DEBOUNCE
+    buffer = pending_edits.get(key)
+    if buffer is None:
+        pending_edits[key] = [event, deadline]
+        asyncio.create_task(flush_edit(key))
+    else:
+        buffer[0], buffer[1] = event, deadline
 
-@client.on(events.MessageDeleted)
+async def flush_edit(key):
+    """Propagate the latest edit of a source message once it has been quiet for EDIT_DEBOUNCE."""
+    await sleep_until_deadline(pending_edits, key)
+    event, _ = pending_edits.pop(key)
+    if not is_connected:
+        return
+    source_message = SourceMessage.from_message(event.message, event.chat_id)
+    for user_id, pair_name, mapping in source_index.get(key[0], []):
+        try:
+            await edit_forwarded_message(source_message, mapping, user_id, pair_name)
+        except Exception as e:
+            logger.error(f"Error editing for '{pair_name}': {e}")
+
+@client.on(events.MessageDeleted(func=is_source_event))
 async def handle_message_deleted(event):
-    """Handle deletions of source messages."""
+    """Handle deletions of source messages, merging those that arrive within DELETE_WINDOW."""
     if not is_connected:
         return
-    for user_id, pairs in channel_mappings.items():
-        for pair_name, mapping in pairs.items():
-            if mapping['active'] and event.chat_id == int(mapping['source']):
-                try:
-                    for deleted_id in event.deleted_ids:
-                        event.message.id = deleted_id
-                        await delete_forwarded_message(event, mapping, user_id, pair_name)
-                except Exception as e:
-                    logger.error(f"Error handling deletion for '{pair_name}': {e}")
-                return
+    deadline = asyncio.get_running_loop().time() + DELETE_WINDOW
+    buffer = pending_deletes.get(event.chat_id)
+    if buffer is None:
+        pending_deletes[event.chat_id] = [set(event.deleted_ids), deadline]
+        asyncio.create_task(flush_deletes(event.chat_id))
+    else:
+        buffer[0].update(event.deleted_ids)
+        buffer[1] = deadline
+
+async def flush_deletes(chat_id):
+    """Propagate the deletions gathered for a source chat once DELETE_WINDOW passes without more."""
+    await sleep_until_deadline(pending_deletes, chat_id)
+    deleted_ids, _ = pending_deletes.pop(chat_id)
+    try:
+        await delete_forwarded_messages(chat_id, sorted(deleted_ids))
+    except Exception as e:
+        logger.error(f"Error handling deletion of {len(deleted_ids)} message(s) in {chat_id}: {e}")
 
 async def check_connection_status():
     """Monitor and update connection status."""
-    global is_connected
+    global is_connected, catch_up_from
     while True:
         current_status = client.is_connected()
         if current_status and not is_connected:
             is_connected = True
             logger.info("📡 Connection established")
+            schedule_catch_up()
         elif not current_status and is_connected:
             is_connected = False
             logger.warning("📡 Connection lost")
+            progress = durable_queue.progress()
+            # An outage not caught up yet keeps its earlier starting point
+            for key, (source_chat, last_msg_id) in (catch_up_from or {}).items():
+                if progress.get(key, (None,))[0] == source_chat:
+                    progress[key] = (source_chat, min(last_msg_id, progress[key][1]))
+            catch_up_from = progress
         await asyncio.sleep(5)
 
-async def queue_processor():
-    """Process queued messages with a delay."""
+async def lane_worker(lane):
+    """Send one destination's queued messages in order, pacing and backing off independently."""
+    loop = asyncio.get_running_loop()
     while True:
-        if is_connected and message_queue:
-            message_data = message_queue.popleft()
-            event, mapping, user_id, pair_name, _ = message_data  # Ignore queued_time here
-            await forward_message_with_retry(event, mapping, user_id, pair_name)
-            await asyncio.sleep(FORWARD_DELAY)
-        else:
+        if not lane.items and lane.spilled:
+            if not is_connected:
+                await asyncio.sleep(1)
+                continue
+            try:
+                await refill_lane(lane)
+            except errors.FloodWaitError as e:
+                rate_limiter.record_flood_wait('get_messages', None, e.seconds)
+            except Exception as e:
+                logger.error(f"Error loading spilled messages for lane {lane.destination}: {e}")
+                await asyncio.sleep(RETRY_DELAY)
+            continue
+        if not lane.items:
+            lane.wakeup.clear()
+            try:
+                await asyncio.wait_for(lane.wakeup.wait(), LANE_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if not lane.items and not lane.spilled:
+                    send_lanes.pop(lane.destination, None)
+                    return
+            continue
+        if not is_connected:
             await asyncio.sleep(1)
+            continue
+        delay = lane.paused_until - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+            continue
+
+        # Wait for send tokens before taking a lane slot so throttled lanes don't block others
+        waited = time.perf_counter()
+        await rate_limiter.acquire('send', lane.destination)
+        waited = time.perf_counter() - waited
+        if not lane.items:
+            continue
+        batch = take_forward_batch(lane)
+        event, mapping, user_id, pair_name = lane.items[0][:4]
+        record_latency(user_id, pair_name, 'rate_wait', waited)
+        dispatched = time.monotonic()
+        try:
+            with timed(user_id, pair_name, 'total'):
+                async with lane_slots:
+                    if batch:
+                        success = await forward_batch_with_retry(batch, mapping, user_id, pair_name)
+                    elif isinstance(event, list):
+                        success = await forward_album_with_retry(event, mapping, user_id, pair_name)
+                    else:
+                        success = await forward_message_with_retry(event, mapping, user_id, pair_name)
+        except errors.FloodWaitError as e:
+            logger.warning(f"Flood wait error on lane {lane.destination} for pair '{pair_name}'; message stays queued")
+            rate_limiter.record_flood_wait('send', lane.destination, e.seconds)
+            record_latency(user_id, pair_name, 'flood_wait', e.seconds)
+            continue
+        if success is None:
+            continue
+        done = [lane.items.popleft() for _ in range(len(batch) or 1)]
+        for item in done:
+            head = item[0][0] if isinstance(item[0], list) else item[0]
+            record_latency(item[2], item[3], 'queue_wait', dispatched - head.queued_at)
+
+        if success:
+            durable_queue.ack(*(item[5] for item in done))
+            lane.failures = 0
+            rate_limiter.record_success('send', lane.destination)
+        else:
+            durable_queue.fail(*(item[5] for item in done))
+            for item in done:
+                record_stat(item[2], item[3], 'failed', len(item[0]) if isinstance(item[0], list) else 1)
+            lane.failures += 1
+            backoff = min(RETRY_DELAY * 2 ** lane.failures, MAX_LANE_BACKOFF)
+            logger.warning(f"Lane {lane.destination} backing off for {backoff} seconds after {lane.failures} failure(s)")
+            lane.pause(backoff)
+
+async def flush_message_store():
+    """Write batched ID mappings to disk at a fixed interval."""
+    while True:
+        await asyncio.sleep(MAPPING_FLUSH_INTERVAL)
+        try:
+            message_store.flush()
+        except Exception as e:
+            logger.error(f"Error flushing message mappings: {e}")
+
+async def flush_metrics():
+    """Persist pair metrics at a fixed interval."""
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            metrics.flush()
+        except Exception as e:
+            logger.error(f"Error flushing metrics: {e}")
+
+async def prune_message_store():
+    """Apply each pair's ID mapping retention limits and drop failed messages past FAILED_RETENTION_DAYS."""
+    while True:
+        await asyncio.sleep(MAPPING_PRUNE_INTERVAL)
+        for user_id, pairs in channel_mappings.items():
+            for pair_name, mapping in pairs.items():
+                try:
+                    removed = message_store.prune(
+                        f"{user_id}:{pair_name}",
+                        mapping.get('mapping_retention_days', MAPPING_RETENTION_DAYS),
+                        mapping.get('mapping_retention_count', MAPPING_RETENTION_COUNT)
+                    )
+                    if removed:
+                        logger.info(f"Pruned {removed} old message mapping(s) for pair '{pair_name}'")
+                except Exception as e:
+                    logger.error(f"Error pruning message mappings for '{pair_name}': {e}")
+        try:
+            removed = durable_queue.prune_failed(FAILED_RETENTION_DAYS)
+            if removed:
+                logger.info(f"Dropped {removed} failed message(s) older than {FAILED_RETENTION_DAYS} day(s)")
+        except Exception as e:
+            logger.error(f"Error pruning failed messages: {e}")
 
 async def check_queue_inactivity():
     """Check for messages stuck in queue too long and notify."""
     while True:
         await asyncio.sleep(60)  # Check every minute
-        if not is_connected or not NOTIFY_CHAT_ID or not message_queue:
+        heads = [lane.items[0] for lane in send_lanes.values() if lane.items]
+        if not is_connected or not NOTIFY_CHAT_ID or not heads:
             continue
         current_time = datetime.now()
-        for i, (event, mapping, user_id, pair_name, queued_time) in enumerate(message_queue):
-            wait_duration = (current_time - queued_time).total_seconds()
-            if wait_duration > QUEUE_INACTIVITY_THRESHOLD:
-                source_msg_id = event.message.id if hasattr(event.message, 'id') else "Unknown"
-                alert_msg = (
-                    f"⏳ Queue Inactivity Alert: Message for pair '{pair_name}' "
-                    f"(Source Msg ID: {source_msg_id}) has been in queue for "
-                    f"{int(wait_duration // 60)} minutes. Queue size: {len(message_queue)}"
-                )
-                logger.warning(alert_msg)
-                await client.send_message(NOTIFY_CHAT_ID, alert_msg)
-                # Optionally remove or mark as notified to avoid repeat alerts
-                break  # Notify only the oldest message to avoid spam
+        # Each lane is FIFO, so the oldest queued message is the oldest lane head
+        event, mapping, user_id, pair_name, queued_time, _ = min(heads, key=lambda item: item[4])
+        wait_duration = (current_time - queued_time).total_seconds()
+        if wait_duration > QUEUE_INACTIVITY_THRESHOLD:
+            if isinstance(event, list):
+                event = event[0]
+            source_msg_id = event.id
+            alert_msg = (
+                f"⏳ Queue Inactivity Alert: Message for pair '{pair_name}' "
+                f"(Source Msg ID: {source_msg_id}) has been in queue for "
+                f"{int(wait_duration // 60)} minutes. Queue size: {queue_depth()}"
+            )
+            logger.warning(alert_msg)
+            await client.send_message(NOTIFY_CHAT_ID, alert_msg)
 
 async def check_pair_inactivity():
     """Notify about inactive pairs."""
@@ -1167,17 +3455,15 @@ async def send_periodic_report():
         for user_id in channel_mappings:
             header = "📊 6-Hour Report\n--------------------\n"
             report = []
-            total_queued = len(message_queue)
+            total_queued = queue_depth()
             for pair_name, data in channel_mappings[user_id].items():
-                stats = pair_stats.get(user_id, {}).get(pair_name, {
-                    'forwarded': 0, 'edited': 0, 'deleted': 0, 'blocked': 0, 'queued': 0, 'last_activity': None
-                })
+                stats = metrics.window(user_id, pair_name, 3600, 6)
                 report.append(
                     f"📌 {pair_name}\n"
                     f"   ➡️ Route: {data['source']} → {data['destination']}\n"
                     f"   ✅ Status: {'Active' if data['active'] else 'Paused'}\n"
                     f"   📈 Fwd: {stats['forwarded']} | Edt: {stats['edited']} | Del: {stats['deleted']}\n"
-                    f"   🚫 Blk: {stats['blocked']} | 📥 Que: {stats['queued']}\n"
+                    f"   🚫 Blk: {stats['blocked']} | 📥 Que: {stats['queued']} | ⚠️ Err: {format_error_rate(stats)}\n"
                     f"---------------"
                 )
             full_message = header + "\n".join(report) + f"\n📥 Queued: {total_queued}"
@@ -1195,19 +3481,102 @@ async def heartbeat():
             logger.error("📡 Disconnected, attempting to reconnect...")
             await client.connect()
 
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_prometheus():
+    """Current bot state in the Prometheus text exposition format."""
+    lines = [
+        "# TYPE forwardbot_connected gauge",
+        f"forwardbot_connected {int(is_connected)}",
+        "# TYPE forwardbot_queue_depth gauge",
+        f"forwardbot_queue_depth {queue_depth()}",
+        "# TYPE forwardbot_lanes gauge",
+        f"forwardbot_lanes {len(send_lanes)}",
+        "# TYPE forwardbot_lane_items gauge",
+    ]
+    lines.extend(
+        f'forwardbot_lane_items{{destination="{destination}"}} {len(lane.items)}'
+        for destination, lane in send_lanes.items()
+    )
+    lines += [
+        "# TYPE forwardbot_flood_waits_total counter",
+        f"forwardbot_flood_waits_total {rate_limiter.flood_waits}",
+        "# TYPE forwardbot_flood_wait_seconds_total counter",
+        f"forwardbot_flood_wait_seconds_total {rate_limiter.flood_wait_seconds}",
+    ]
+    for counter in METRIC_COUNTERS:
+        lines.append(f"# TYPE forwardbot_{counter}_total counter")
+        for user_id, pairs in pair_stats.items():
+            for pair_name, stats in pairs.items():
+                lines.append(
+                    f'forwardbot_{counter}_total{{user="{prometheus_label(user_id)}",pair="{prometheus_label(pair_name)}"}}'
+                    f" {stats.get(counter, 0)}"
+                )
+    lines.append("# TYPE forwardbot_stage_latency_seconds summary")
+    for (user_id, pair_name, stage), histogram in latency_histograms.items():
+        labels = f'user="{prometheus_label(user_id)}",pair="{prometheus_label(pair_name)}",stage="{stage}"'
+        for quantile in (0.5, 0.95, 0.99):
+            lines.append(
+                f'forwardbot_stage_latency_seconds{{{labels},quantile="{quantile}"}} {histogram.percentile(quantile * 100):.6f}'
+            )
+        lines.append(f"forwardbot_stage_latency_seconds_count{{{labels}}} {histogram.total}")
+    return "\n".join(lines) + "\n"
+
+async def serve_metrics(reader, writer):
+    """Answer one scrape of the Prometheus endpoint."""
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        method, path = request.split(b" ", 2)[:2]
+        if method == b"GET" and path.split(b"?")[0] == b"/metrics":
+            status, body = "200 OK", render_prometheus().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+        pass
+    except Exception as e:
+        logger.error(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
 async def main():
     """Main bot initialization and runtime."""
+    global durable_queue, message_store, hash_pool, metrics, catch_up_from
     load_mappings()
+    durable_queue = DurableQueue(STATE_DB_FILE)
+    catch_up_from = durable_queue.progress()  # taken before connecting, so no live message is counted yet
+    resume_queued_messages()
+    message_store = MessageStore(STATE_DB_FILE)
+    message_store.warm(
+        [f"{user_id}:{pair_name}" for user_id, pairs in channel_mappings.items() for pair_name in pairs],
+        REPLY_WARMUP_PER_PAIR
+    )
+    hash_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    metrics = MetricsStore(STATE_DB_FILE)
+    metrics.restore()
     tasks = [
         check_connection_status(),
         send_periodic_report(),
         check_pair_inactivity(),
         heartbeat(),
-        queue_processor(),
+        flush_message_store(),
+        prune_message_store(),
+        flush_metrics(),
+        refresh_input_peers(),
         check_queue_inactivity()  # New task for queue monitoring
     ]
     for task in tasks:
         asyncio.create_task(task)
+    if METRICS_PORT:
+        await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+        logger.info(f"📈 Metrics endpoint listening on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
     logger.info("🤖 Bot is starting...")
 
     try:
@@ -1218,22 +3587,29 @@ async def main():
             code = input("Please enter the verification code you received: ")
             await client.sign_in(phone=phone, code=code)
 
-        global is_connected, MONITOR_CHAT_ID, NOTIFY_CHAT_ID
+        global is_connected, MONITOR_CHAT_ID, NOTIFY_CHAT_ID, OWNER_ID
         is_connected = client.is_connected()
-        MONITOR_CHAT_ID = (await client.get_me()).id
+        OWNER_ID = (await client.get_me()).id
+        MONITOR_CHAT_ID = OWNER_ID
         NOTIFY_CHAT_ID = MONITOR_CHAT_ID  # Ensure NOTIFY_CHAT_ID is set
 
         if is_connected:
             logger.info("📡 Initial connection established")
         else:
             logger.warning("📡 Initial connection not established")
+        resume_clone_jobs()
+        if is_connected:
+            schedule_catch_up()
 
         await client.run_until_disconnected()
     except Exception as e:
         logger.error(f"❌ Fatal error: {e}", exc_info=True)
     finally:
         logger.info("🤖 Bot is shutting down...")
-        save_mappings()
+        save_mappings_now()
+        message_store.flush()
+        metrics.flush()
+        hash_pool.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,14 @@
+"""Perceptual image hashing run in ForwardBot's hash pool workers.
+
+Kept apart from bot.py, which opens the Telegram session and log files on import, so a worker
+process only has to load this module.
+"""
+import io
+
+import imagehash
+from PIL import Image
+
+
+def compute_image_hash(data):
+    """Decode an image and return its perceptual hash."""
+    return str(imagehash.phash(Image.open(io.BytesIO(data))))